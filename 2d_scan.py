@@ -2,7 +2,10 @@
 Python3 script that generates a 2D grid of scan points and energies, then
 creates a 2D contour plot of the PES
 
-TODO: Scan range reading from input file
+Scan points are read from an ORCA .relaxscanact.dat, from x and y columns
+of the csv, or generated from the %paras / Scan definition of an ORCA input.
+Scans over more than two coordinates are held as an N-D grid and plotted as
+slices at fixed coordinate values or as minimum-energy projections
 
 Written by AJS
 """
@@ -11,10 +14,33 @@ import os
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib as mpl
-from scipy.interpolate import griddata
-from scipy.interpolate import Rbf
-from pandas import read_csv
+from scipy.interpolate import Rbf, RBFInterpolator, CloughTocher2DInterpolator, LinearNDInterpolator
+from scipy.interpolate import RegularGridInterpolator
 import argparse
+import hashlib
+import pickle
+import re
+import csv
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import dijkstra, minimum_spanning_tree
+from scipy.ndimage import minimum_filter
+
+
+INTERPOLATORS = ("auto", "spline", "rbf", "clough_tocher", "griddata", "numpy", "Rbf")
+RBF_NEIGHBORS = 50  # scan points in each local RBF solve
+GLOBAL_RBF_MAX_POINTS = 1000  # scattered points up to which auto uses a global RBF instead of Clough-Tocher
+
+# [start, end, step] of the x and y scan coordinates when neither the csv nor --scan_input define them
+DEFAULT_SCAN = ([1.5, 2.1, 0.1], [2.3, 1.1, -0.1])
+RANGE_PATTERN = r'^(.+?)\s*=\s*\{?\s*([-+\d.eE]+)\s*,\s*([-+\d.eE]+)\s*,\s*(\d+)\s*\}?$'
+LIST_PATTERN = r'^(.+?)\s*=\s*\[([^\]]*)\]$'
+
+# Neighbours of a grid point in order round the ring, as (row, column) offsets
+RING = ((-1, -1), (-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1))
+MIN_CONTOUR_RANGE = 1e-3  # kcal/mol, energy span of the levels of a flat surface
+MEP_ENERGY_OFFSET = 0.01  # fraction of the energy range added to the path weights so flat regions still cost length
 
 
 def get_args():
@@ -51,11 +77,113 @@ def get_args():
                            default=10,
                            type=int,
                            help="Specify number of levels for contour plot")
-    return my_parser.parse_args()
-
-
-def get_scan_params():
-    return None
+    my_parser.add_argument("--xy_columns",
+                           nargs='+',
+                           type=int,
+                           help="Columns of the csv holding the scan coordinates, two or more, rows may be in any order")
+    my_parser.add_argument("--scan_input",
+                           action='store',
+                           type=str,
+                           help="ORCA input or output whose %%paras or Scan block defines the scan grid of the csv energies")
+    my_parser.add_argument("-i", "--interpolator",
+                           action='store',
+                           default="auto",
+                           choices=INTERPOLATORS,
+                           help="Interpolation backend, auto uses a spline on complete regular grids, RBF on small scattered "
+                                "scans and Clough-Tocher on large ones")
+    my_parser.add_argument("--interpolant",
+                           action='store',
+                           type=str,
+                           help="Pickle file to save the fitted interpolant to and reuse it from, so that changing "
+                                "--levels or the resolution does not refit")
+    my_parser.add_argument("--critical_points",
+                           action='store_true',
+                           help="Locate minima and saddles on the interpolated surface, overlay them and write them "
+                                "to <plotname>_critical_points.csv")
+    my_parser.add_argument("--mep",
+                           nargs=2,
+                           type=int,
+                           metavar=('MIN1', 'MIN2'),
+                           help="Find the minimum energy path between two minima, numbered from 0 in order of energy, "
+                                "and write it to <plotname>_mep.csv")
+    my_parser.add_argument("--axes",
+                           nargs=2,
+                           type=int,
+                           default=[0, 1],
+                           metavar=('X', 'Y'),
+                           help="Scan coordinates, numbered from 0, to plot on the x and y axes of scans with more than "
+                                "two coordinates")
+    my_parser.add_argument("--fix",
+                           nargs=2,
+                           type=float,
+                           action='append',
+                           metavar=('AXIS', 'VALUE'),
+                           help="Plot the slice at VALUE of scan coordinate AXIS, repeat for each coordinate not plotted")
+    my_parser.add_argument("--project",
+                           action='store_true',
+                           help="Plot the lowest energy over the coordinates not plotted (relaxed surface), the default "
+                                "for scans with more than two coordinates and no --fix")
+    my_parser.add_argument("--all_slices",
+                           action='store_true',
+                           help="Save a contour of every slice through the scan values of the coordinates not plotted, "
+                                "with common levels, as <plotname>_<coordinate>=<value>.pdf")
+    my_parser.add_argument("-b", "--batch",
+                           nargs='*',
+                           type=int,
+                           metavar='COLUMN',
+                           help="Fit several energy columns of the csv (all non-coordinate columns if none are given) "
+                                "in parallel and save their contours with shared axes and levels to <plotname>_batch.pdf")
+    my_parser.add_argument("--difference",
+                           nargs=2,
+                           type=int,
+                           action='append',
+                           metavar=('A', 'B'),
+                           help="With --batch, also plot the surface of column A minus column B, repeat for more pairs")
+    my_parser.add_argument("-j", "--workers",
+                           type=int,
+                           default=None,
+                           help="Number of processes used to fit the --batch columns, defaults to all cores")
+    args = my_parser.parse_args()
+
+    if args.difference and args.batch is None:
+        my_parser.error("--difference requires --batch")
+    return args
+
+
+def get_scan_params(filename):
+    # Scan axes defined in an ORCA input, or the input echoed in its output, as {name: values}. Reads
+    # %paras (NAME = start, end, n or NAME = [v1 v2 ...]) and %geom Scan (B 0 1 = start, end, n) blocks
+    axes = {}
+    in_block = False
+    with open(filename, 'r') as file:
+        for line in file:
+            # strip the "|  12> " prefix of input lines echoed in an ORCA output
+            line = re.sub(r'^\s*\|\s*\d+>', '', line).split('#')[0].strip()
+            lower = line.lower()
+            if lower.startswith('%paras') or re.match(r'(%geom\s+)?scan\b', lower):
+                in_block = True
+                continue
+            if lower == 'end':
+                in_block = False
+                continue
+            if not in_block:
+                continue
+
+            match = re.match(RANGE_PATTERN, line)
+            if match:
+                name, start, end, num_points = match.groups()
+                axes[name.strip()] = np.linspace(float(start), float(end), int(num_points))
+                continue
+            match = re.match(LIST_PATTERN, line)
+            if match:
+                name, values = match.groups()
+                axes[name.strip()] = np.array(values.replace(',', ' ').split(), dtype=float)
+
+    if not axes:
+        raise ValueError(f"No %paras or Scan definitions found in {filename}")
+    print(f"Read scan coordinates {', '.join(axes)} from {filename}")
+
+    return axes
 
 
 def get_energies(filename, column):
@@ -65,8 +193,102 @@ def get_energies(filename, column):
     return energies
 
 
-def _energies_ha_to_kcal(energies):
-    energy_min = np.min(energies)
+def read_relaxscanact(filename):
+    # ORCA .relaxscanact.dat: one line per converged scan point, the scan coordinates followed by the energy
+    data = np.loadtxt(filename, ndmin=2)
+    print(f"Read {len(data)} scan points from {filename}")
+
+    return data[:, :-1], data[:, -1]
+
+
+def read_scan_csv(filename, coord_columns, column):
+    # CSV with explicit coordinate columns, rows may come in any order and scan points may be missing
+    data = np.genfromtxt(filename, delimiter=',', skip_header=1, dtype=float, ndmin=2)
+    print(f"Read {len(data)} scan points from {filename}")
+
+    return data[:, list(coord_columns)], data[:, column]
+
+
+def _csv_header(filename):
+    with open(filename, 'r', newline='') as file:
+        return next(csv.reader(file))
+
+
+def load_scan(filename, column=None, xy_columns=None, scan_file=None):
+    # Scan points (n, n_coords), energies (n,) and coordinate names from an ORCA .relaxscanact.dat, a CSV with
+    # coordinate columns, or a CSV of energies in the order of the scan grid defined in scan_file (DEFAULT_SCAN
+    # without one)
+    if filename.endswith('.dat'):
+        points, energies = read_relaxscanact(filename)
+        return points, energies, [f"q{i}" for i in range(points.shape[1])]
+
+    if xy_columns is not None:
+        points, energies = read_scan_csv(filename, xy_columns, column)
+        return points, energies, _column_names(_csv_header(filename), xy_columns, "q")
+
+    return _grid_scan(get_energies(filename, column)[:, 0], scan_file)
+
+
+def load_scan_columns(filename, columns=None, xy_columns=None, scan_file=None, extra_columns=()):
+    # Like load_scan for several energy columns of one CSV, read in a single pass. Returns the scan points,
+    # energies (n, n_columns), coordinate names, the columns read and their names. Without columns every column
+    # that is not a scan coordinate is used, extra_columns are always read
+    data = np.genfromtxt(filename, delimiter=',', skip_header=1, dtype=float, ndmin=2)
+    header = _csv_header(filename)
+    print(f"Read {len(data)} rows of {data.shape[1]} columns from {filename}")
+    columns = list(columns) if columns else _energy_columns(data, header, xy_columns, scan_file)
+    columns += [c for c in extra_columns if c not in columns]
+    energies = data[:, columns]
+    column_names = _column_names(header, columns, "column ")
+
+    if xy_columns is not None:
+        return data[:, list(xy_columns)], energies, _column_names(header, xy_columns, "q"), columns, column_names
+
+    points, energies, names = _grid_scan(energies, scan_file)
+    return points, energies, names, columns, column_names
+
+
+def _energy_columns(data, header, xy_columns=None, scan_file=None):
+    # Every column that is not a scan coordinate. Without xy_columns the coordinates come from the scan grid, so
+    # columns named after a grid coordinate or holding its values row by row are left out
+    if xy_columns is not None:
+        return [i for i in range(data.shape[1]) if i not in xy_columns]
+
+    points, _, names = _grid_scan(data[:, :0], scan_file)
+    points = points[:len(data)]
+    names = {name.strip().lower() for name in names}
+    return [i for i in range(data.shape[1])
+            if _column_names(header, [i], "")[0].lower() not in names
+            and not any(np.allclose(data[:, i], points[:, k]) for k in range(points.shape[1]))]
+
+
+def _column_names(header, columns, prefix):
+    return [header[i].strip() if i < len(header) else f"{prefix}{i}" for i in columns]
+
+
+def _grid_scan(energies, scan_file=None):
+    # Points of the scan grid defined in scan_file (DEFAULT_SCAN without one) for energies given in grid order
+    if scan_file is not None:
+        params = get_scan_params(scan_file)
+        names, axes = list(params), list(params.values())
+    else:
+        names, axes = ["x", "y"], [_scan_axis(scan_input) for scan_input in DEFAULT_SCAN]
+    points = scan_points(axes)
+
+    # a scan that stopped early only has energies for the first points of the grid
+    if len(energies) < len(points):
+        print(f"Only {len(energies)} of {len(points)} scan points have energies")
+        missing = np.full((len(points) - len(energies),) + energies.shape[1:], np.nan)
+        energies = np.concatenate((energies, missing))
+    elif len(energies) > len(points):
+        raise ValueError(f"{len(energies)} energies for a scan grid of {len(points)} points")
+
+    return points, energies, names
+
+
+def _energies_ha_to_kcal(energies, energy_min=None):
+    if energy_min is None:
+        energy_min = np.min(energies)
     energies -= energy_min
     energies *= 627.509
     return energies
@@ -80,38 +302,29 @@ def _get_scan_length(scan_input):
     return scan_length
 
 
-def _generate_2d_grid(x_input, y_input):
-    x_scan_len = _get_scan_length(x_input)
-    print("Number of x values to scan over: ", x_scan_len)
+def _scan_axis(scan_input):
+    # Values of one scan coordinate from [start, end, step]
+    return scan_input[0] + np.arange(_get_scan_length(scan_input)) * scan_input[2]
 
-    y_scan_len = _get_scan_length(y_input)
-    print("Number of y values to scan over: ", y_scan_len)
 
-    arr = np.zeros((x_scan_len*y_scan_len, 2))
+def scan_points(axes):
+    # Every combination of the axis values, the last axis varying fastest, (n_points, n_axes)
+    grids = np.meshgrid(*axes, indexing='ij')
 
-    k = 0  # counter
-    for i in range(x_scan_len):
-        for j in range(y_scan_len):
-            arr[k, 0] = x_input[0] + i * x_input[2]
-            arr[k, 1] = y_input[0] + j * y_input[2]
-            k += 1
+    return np.stack(grids, axis=-1).reshape(-1, len(axes))
 
-    return arr, x_scan_len, y_scan_len
 
+def _clean_data(points, energies, energy_reference=None):
 
-def _clean_data(arr, energies):
+    # Remove scan points with a missing coordinate or energy from the (n, n_coords) points and their energies
+    points = np.asarray(points, dtype=float).reshape(len(energies), -1)
+    z = np.array(energies, dtype=float).ravel()
+    keep = ~(np.isnan(points).any(axis=1) | np.isnan(z))
 
-    # Stack (x, y) coords with energies, and remove any nan rows
-    z = np.array(energies)
-    data = np.column_stack((arr, z))
-    data = data[~np.isnan(data).any(axis=1)]
+    # Energies relative to the minimum (or energy_reference) in kcal/mol
+    clean_z = _energies_ha_to_kcal(z[keep], energy_reference)
 
-    # Extract the x, y, and z values from the array
-    clean_x = data[:, 0]
-    clean_y = data[:, 1]
-    clean_z = _energies_ha_to_kcal(data[:, 2])
-
-    return clean_x, clean_y, clean_z
+    return points[keep], clean_z
 
 
 def _set_interpolation_vals(n_x_vals, n_y_vals, x_scan_len, y_scan_len):
@@ -127,51 +340,370 @@ def _set_interpolation_vals(n_x_vals, n_y_vals, x_scan_len, y_scan_len):
     return n_x_vals, n_y_vals
 
 
-def _interpolate_data(x, y, z, n_x_vals, n_y_vals, interpolator="Rbf"):
+def scan_grid(points, energies, decimals=8):
+    # Axes and N-D array of the energies on every combination of the distinct values of each scan coordinate,
+    # NaN where a scan point is missing
+    axes, indices = zip(*(np.unique(np.round(column, decimals), return_inverse=True) for column in points.T))
+    grid = np.full([len(axis) for axis in axes], np.nan)
+    grid[indices] = energies
 
-    # Create a grid of x and y values
-    X, Y = np.meshgrid(np.linspace(min(x), max(x), n_x_vals), np.linspace(min(y), max(y), n_y_vals))
+    return list(axes), grid
+
+
+def _regular_grid(points, z):
+    # Axes and N-D energy grid if the points cover every combination of their coordinate values exactly
+    # once, otherwise None
+    axes, grid = scan_grid(points, z)
+    if grid.size != len(z) or min(len(axis) for axis in axes) < 2 or np.isnan(grid).any():
+        return None
+
+    return axes, grid
+
+
+def _choose_interpolator(points, z):
+    # Splines on complete regular grids, a global RBF on small scattered sets and Clough-Tocher on larger
+    # 2-D ones, where every RBF evaluation (global or local) becomes the bottleneck on fine grids
+    if _regular_grid(points, z) is not None:
+        return "spline"
+    if len(z) <= GLOBAL_RBF_MAX_POINTS or points.shape[1] != 2:
+        return "rbf"
+    return "clough_tocher"
+
+
+def _bilinear(xs, ys, grid, X, Y):
+    # Bilinear interpolation on a regular grid, extrapolating linearly from the edge cells
+    i = np.clip(np.searchsorted(xs, X) - 1, 0, len(xs) - 2)
+    j = np.clip(np.searchsorted(ys, Y) - 1, 0, len(ys) - 2)
+    tx = (X - xs[i]) / (xs[i + 1] - xs[i])
+    ty = (Y - ys[j]) / (ys[j + 1] - ys[j])
+
+    return ((1 - tx) * (1 - ty) * grid[i, j] + tx * (1 - ty) * grid[i + 1, j]
+            + (1 - tx) * ty * grid[i, j + 1] + tx * ty * grid[i + 1, j + 1])
+
+
+def _data_key(points, z, interpolator):
+    digest = hashlib.sha256(interpolator.encode())
+    for values in (points, z):
+        digest.update(np.ascontiguousarray(values, dtype=float).tobytes())
+
+    return digest.hexdigest()
 
-    # Interpolate the z values onto the grid using numpy
-    if interpolator == "numpy":
-        Z = np.interp(X.flatten(), x, z).reshape(X.shape) + np.interp(Y.flatten(), y, z).reshape(Y.shape)
 
-    # Interpolate the z values onto the grid using scipy griddata interpolation, deals with NaN values
+def fit_interpolant(points, z, interpolator="auto"):
+    # Fit one of the INTERPOLATORS to scattered (n_points, n_dims) points and their energies. The fitted
+    # interpolant is a dict that can be pickled and evaluated on any grid with evaluate_interpolant
+    points = np.asarray(points, dtype=float)
+    num_dims = points.shape[1]
+    if interpolator == "auto":
+        interpolator = _choose_interpolator(points, z)
+    print(f"Using interpolator: {interpolator}")
+
+    if interpolator in ("numpy", "clough_tocher") and num_dims != 2:
+        raise ValueError(f"The {interpolator} interpolator only handles 2-D scans")
+    interpolant = {'interpolator': interpolator, 'ranges': list(zip(points.min(axis=0), points.max(axis=0)))}
+
+    if interpolator in ("spline", "numpy"):
+        grid = _regular_grid(points, z)
+        if grid is None:
+            raise ValueError(f"The {interpolator} interpolator needs energies on a complete regular grid")
+        axes, values = grid
+        if interpolator == "spline":
+            method = "cubic" if min(len(axis) for axis in axes) >= 4 else "linear"
+            interpolant['model'] = RegularGridInterpolator(axes, values, method=method, bounds_error=False,
+                                                           fill_value=None)
+        else:
+            interpolant['model'] = (axes[0], axes[1], values)
+
+    # Thin plate spline RBF, global up to GLOBAL_RBF_MAX_POINTS points, otherwise each evaluation only solves
+    # for its RBF_NEIGHBORS nearest scan points
+    elif interpolator == "rbf":
+        neighbors = RBF_NEIGHBORS if len(z) > GLOBAL_RBF_MAX_POINTS else None
+        interpolant['model'] = RBFInterpolator(points, z, neighbors=neighbors, kernel='thin_plate_spline')
+
+    elif interpolator == "clough_tocher":
+        interpolant['model'] = CloughTocher2DInterpolator(points, z)
+
+    # Linear interpolation on the Delaunay triangulation, same as griddata(method='linear')
     elif interpolator == "griddata":
-        Z = griddata((x, y), z, (X, Y), method='linear')
+        interpolant['model'] = LinearNDInterpolator(points, z)
 
-    # Interpolate the z values onto the grid using scipy Rbf interpolation, deals with NaN values
+    # Dense global RBF, O(N^3) to fit, only practical for coarse scans
     elif interpolator == "Rbf":
-        rbf = Rbf(x, y, z, function='multiquadric')
-        Z = rbf(X, Y)
+        interpolant['model'] = Rbf(*points.T, z, function='multiquadric')
 
-    print(f"Using interpolator: {interpolator}")
+    else:
+        raise ValueError(f"Unknown interpolator {interpolator}, choose from {', '.join(INTERPOLATORS)}")
 
-    return X, Y, Z
+    return interpolant
+
+
+def evaluate_interpolant(interpolant, *grids):
+    # Energies at the points given by one coordinate array per scan dimension, e.g. X, Y from meshgrid
+    interpolator = interpolant['interpolator']
+    model = interpolant['model']
+
+    if interpolator == "numpy":
+        return _bilinear(*model, *grids)
+    if interpolator == "Rbf":
+        return model(*grids)
+
+    stacked = np.stack(grids, axis=-1)
+    if interpolator == "rbf":
+        return model(stacked.reshape(-1, len(grids))).reshape(stacked.shape[:-1])
+
+    return model(stacked)
+
+
+def load_interpolant(points, z, interpolator="auto", interpolant_file=None):
+    # Reuse the interpolant saved in interpolant_file if it was fitted to the same data with the same
+    # interpolator, otherwise fit it and save it there
+    key = _data_key(points, z, interpolator)
+    if interpolant_file is not None and os.path.isfile(interpolant_file):
+        with open(interpolant_file, 'rb') as file:
+            interpolant = pickle.load(file)
+        if interpolant.get('key') == key:
+            print(f"Using interpolant saved in {interpolant_file}")
+            return interpolant
+        print(f"Interpolant saved in {interpolant_file} was fitted to other data, refitting")
+
+    interpolant = fit_interpolant(points, z, interpolator)
+    interpolant['key'] = key
+    if interpolant_file is not None:
+        print(f"Saving interpolant as {interpolant_file}")
+        with open(interpolant_file, 'wb') as file:
+            pickle.dump(interpolant, file)
+
+    return interpolant
+
+
+def slice_scan(axes, grid, fixed):
+    # Slice of an N-D scan grid at fixed coordinate values {axis: value}, interpolating linearly between
+    # the two scan values around each fixed value. Returns the remaining axis numbers, their values and the grid
+    remaining = [axis for axis in range(grid.ndim) if axis not in fixed]
+    for axis in sorted(fixed, reverse=True):
+        values, value = axes[axis], fixed[axis]
+        if not values[0] - 1e-8 <= value <= values[-1] + 1e-8:
+            raise ValueError(f"{value} is outside the scanned range {values[0]} to {values[-1]} of coordinate {axis}")
+        if len(values) == 1:
+            grid = np.take(grid, 0, axis=axis)
+            continue
+        k = min(max(np.searchsorted(values, value) - 1, 0), len(values) - 2)
+        t = (value - values[k]) / (values[k + 1] - values[k])
+        if np.isclose(t, 0):
+            grid = np.take(grid, k, axis=axis)
+        elif np.isclose(t, 1):
+            grid = np.take(grid, k + 1, axis=axis)
+        else:
+            grid = (1 - t) * np.take(grid, k, axis=axis) + t * np.take(grid, k + 1, axis=axis)
+
+    return remaining, [axes[axis] for axis in remaining], grid
+
+
+def project_scan(axes, grid, keep):
+    # Relaxed-surface projection of an N-D scan grid onto the axes in keep (in that order), taking the lowest
+    # energy over every other scan coordinate and ignoring missing points
+    dropped = tuple(axis for axis in range(grid.ndim) if axis not in keep)
+    projected = np.fmin.reduce(grid, axis=dropped) if dropped else grid
+    remaining = [axis for axis in range(grid.ndim) if axis in keep]
+    projected = np.transpose(projected, [remaining.index(axis) for axis in keep])
+
+    return [axes[axis] for axis in keep], projected
+
+
+def orient_slice(remaining, slice_axes, slice_grid, plot_axes):
+    # Put the remaining axes of a slice in the order of plot_axes
+    order = [remaining.index(axis) for axis in plot_axes]
+
+    return [slice_axes[i] for i in order], np.transpose(slice_grid, order)
+
+
+def _interpolate_data(x, y, z, n_x_vals, n_y_vals, interpolator="auto", interpolant_file=None):
+
+    # Create a grid of x and y values
+    X, Y = np.meshgrid(np.linspace(min(x), max(x), n_x_vals), np.linspace(min(y), max(y), n_y_vals))
 
+    interpolant = load_interpolant(np.column_stack((x, y)), z, interpolator, interpolant_file)
+    Z = evaluate_interpolant(interpolant, X, Y)
 
-def generate_contour(x_input, y_input, energies, n_x_vals=None, n_y_vals=None,
-                     levels=10, interp="Rbf", x_label=None, y_label=None, z_label=None,
-                     plt_title=None, plt_save=False, plt_show=True, plt_name="2D_plot.pdf"):
+    return X, Y, Z
 
-    # Generate 2D array of scan points
-    arr, x_scan_len, y_scan_len = _generate_2d_grid(x_input, y_input)
-    clean_x, clean_y, clean_z = _clean_data(arr, energies)
+
+def _neighbour_differences(Z):
+    # Z of the 8 neighbours minus Z of each interior grid point, going round the ring, (8, n_y - 2, n_x - 2)
+    centre = Z[1:-1, 1:-1]
+    n_y, n_x = Z.shape
+
+    return np.array([Z[1 + di:n_y - 1 + di, 1 + dj:n_x - 1 + dj] - centre for di, dj in RING])
+
+
+def find_critical_points(X, Y, Z):
+    # Minima and first-order saddles of an interpolated surface on a meshgrid. A minimum lies below all
+    # 8 neighbours, a saddle sees the neighbour energies cross its own at least 4 times going round the ring,
+    # and both must have the matching finite-difference Hessian (positive definite / one negative eigenvalue)
+    x_axis, y_axis = X[0, :], Y[:, 0]
+    grad_y, grad_x = np.gradient(Z, y_axis, x_axis)
+    hess_yy, hess_yx = np.gradient(grad_y, y_axis, x_axis)
+    hess_xy, hess_xx = np.gradient(grad_x, y_axis, x_axis)
+    det = (hess_xx * hess_yy - 0.25 * (hess_xy + hess_yx) ** 2)[1:-1, 1:-1]
+
+    differences = _neighbour_differences(Z)
+    finite = np.all(np.isfinite(differences), axis=0)
+    above = differences > 0
+    sign_changes = np.sum(above != np.roll(above, 1, axis=0), axis=0)
+
+    is_minimum = finite & np.all(above, axis=0) & (det > 0) & (hess_xx[1:-1, 1:-1] > 0)
+    is_saddle = finite & (sign_changes >= 4) & (det < 0)
+
+    # a saddle between grid points is seen from neighbouring points too, keep the one with the smallest gradient
+    gradient = np.where(is_saddle, np.hypot(grad_x, grad_y)[1:-1, 1:-1], np.inf)
+    is_saddle &= gradient == minimum_filter(gradient, size=3, mode='constant', cval=np.inf)
+
+    critical_points = []
+    for kind, mask in (("minimum", is_minimum), ("saddle", is_saddle)):
+        i, j = np.nonzero(mask)
+        i, j = i + 1, j + 1
+        order = np.argsort(Z[i, j])
+        for k in order:
+            critical_points.append((kind, X[i[k], j[k]], Y[i[k], j[k]], Z[i[k], j[k]], i[k], j[k]))
+
+    for kind, x, y, z, i, j in critical_points:
+        print(f"{kind} at ({x:.3f}, {y:.3f}), E = {z:.2f}")
+
+    return critical_points
+
+
+def _grid_edges(X, Y, Z):
+    # Edges between each grid point and its 8 neighbours with finite energies: node indices, lengths and the
+    # higher energy of the two ends
+    n_y, n_x = Z.shape
+    nodes = np.arange(Z.size).reshape(Z.shape)
+    dx, dy = X[0, 1] - X[0, 0], Y[1, 0] - Y[0, 0]
+    starts, ends, lengths, heights = [], [], [], []
+
+    for di, dj in ((0, 1), (1, 0), (1, 1), (1, -1)):
+        rows = slice(0, n_y - di)
+        cols = slice(max(0, -dj), n_x - max(0, dj))
+        rows_to = slice(di, n_y)
+        cols_to = slice(max(0, dj), n_x + min(0, dj))
+        z_from, z_to = Z[rows, cols], Z[rows_to, cols_to]
+        valid = np.isfinite(z_from) & np.isfinite(z_to)
+        starts.append(nodes[rows, cols][valid])
+        ends.append(nodes[rows_to, cols_to][valid])
+        lengths.append(np.full(np.count_nonzero(valid), np.hypot(di * dy, dj * dx)))
+        heights.append(np.maximum(z_from, z_to)[valid])
+
+    return np.concatenate(starts), np.concatenate(ends), np.concatenate(lengths), np.concatenate(heights)
+
+
+def _tree_path(graph, start, end):
+    predecessors = dijkstra(graph, directed=False, indices=start, return_predecessors=True)[1]
+    if predecessors[end] < 0 and start != end:
+        raise ValueError("The two minima are not connected on the interpolated surface")
+    path = [end]
+    while path[-1] != start:
+        path.append(predecessors[path[-1]])
+
+    return np.array(path[::-1])
+
+
+def minimum_energy_path(X, Y, Z, start, end):
+    # Path between grid points start and end, given as (i, j), that crosses the lowest possible barrier. The
+    # barrier is the highest edge on the path between them in the minimum spanning tree of the grid graph
+    # weighted by the higher energy of each edge. The path is then the shortest route, weighting each edge by
+    # its length and energy, that never climbs above that barrier
+    n_nodes = Z.size
+    starts, ends, lengths, heights = _grid_edges(X, Y, Z)
+    z_min = np.nanmin(Z)
+    start = np.ravel_multi_index(start, Z.shape)
+    end = np.ravel_multi_index(end, Z.shape)
+
+    # offset so that zero energy differences still give positive weights, which csgraph treats as edges
+    offset = MEP_ENERGY_OFFSET * max(np.nanmax(Z) - z_min, 1e-12)
+    tree = minimum_spanning_tree(coo_matrix((heights - z_min + offset, (starts, ends)), shape=(n_nodes, n_nodes)))
+    tree_path = _tree_path(tree, start, end)
+    barrier = np.max(Z.ravel()[tree_path])
+
+    allowed = heights <= barrier
+    weights = lengths[allowed] * (heights[allowed] - z_min + offset)
+    graph = coo_matrix((weights, (starts[allowed], ends[allowed])), shape=(n_nodes, n_nodes)).tocsr()
+    path = _tree_path(graph, start, end)
+
+    x, y, z = X.ravel()[path], Y.ravel()[path], Z.ravel()[path]
+    arc_length = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+    print(f"Minimum energy path of {len(path)} points, barrier {np.max(z) - z[0]:.2f} from the first minimum, "
+          f"{np.max(z) - z[-1]:.2f} from the second")
+
+    return np.column_stack((arc_length, x, y, z))
+
+
+def write_critical_points(critical_points, mep, plt_name):
+    stem = os.path.splitext(plt_name)[0]
+    print(f"Writing critical points to {stem}_critical_points.csv")
+    with open(f"{stem}_critical_points.csv", 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["Type", "x", "y", "Energy"])
+        for kind, x, y, z, i, j in critical_points:
+            writer.writerow([kind, x, y, z])
+
+    if mep is not None:
+        print(f"Writing minimum energy path to {stem}_mep.csv")
+        np.savetxt(f"{stem}_mep.csv", mep, delimiter=',', header="Arc length,x,y,Energy", comments='')
+
+
+def _plot_critical_points(critical_points, mep):
+    for kind, marker, color in (("minimum", "o", "black"), ("saddle", "X", "gold")):
+        points = np.array([point[1:3] for point in critical_points if point[0] == kind]).reshape(-1, 2)
+        plt.scatter(points[:, 0], points[:, 1], marker=marker, color=color, edgecolors='black', zorder=3, label=kind)
+
+    if mep is not None:
+        plt.plot(mep[:, 1], mep[:, 2], color='black', linestyle='--', linewidth=1.5, zorder=2, label="MEP")
+        top = np.argmax(mep[:, 3])
+        plt.scatter(mep[top, 1], mep[top, 2], marker="*", s=150, color='gold', edgecolors='black', zorder=4)
+
+    plt.legend(loc='best', fontsize='small')
+
+
+def generate_contour(points, energies, n_x_vals=None, n_y_vals=None,
+                     levels=10, interp="auto", x_label=None, y_label=None, z_label=None,
+                     plt_title=None, plt_save=False, plt_show=True, plt_name="2D_plot.pdf", interpolant_file=None,
+                     critical_points=False, mep=None, energy_reference=None):
+
+    # Remove missing scan points, then count the distinct x and y values that remain
+    clean_points, clean_z = _clean_data(points, energies, energy_reference)
+    if clean_points.shape[1] != 2:
+        raise ValueError(f"Contours need two scan coordinates, reduce the {clean_points.shape[1]} coordinates of "
+                         "this scan with reduce_scan first")
+    clean_x, clean_y = clean_points.T
+    x_scan_len = len(np.unique(np.round(clean_x, 8)))
+    y_scan_len = len(np.unique(np.round(clean_y, 8)))
     n_x_vals, n_y_vals = _set_interpolation_vals(n_x_vals, n_y_vals, x_scan_len, y_scan_len)
-    X, Y, Z = _interpolate_data(clean_x, clean_y, clean_z, n_x_vals, n_y_vals, interp)
+    X, Y, Z = _interpolate_data(clean_x, clean_y, clean_z, n_x_vals, n_y_vals, interp, interpolant_file)
 
     # Create the contour plot
     cmap = mpl.cm.bwr
     plt.contourf(X, Y, Z, levels=levels, cmap=cmap, alpha=0.9)
     print(f"Using {levels} levels in contourf")
 
+    # Locate minima and saddles, then optionally the path between two of the minima (by energy rank)
+    if critical_points or mep is not None:
+        found = find_critical_points(X, Y, Z)
+        path = None
+        if mep is not None:
+            minima = [point for point in found if point[0] == "minimum"]
+            if max(mep) >= len(minima):
+                raise ValueError(f"--mep needs minima {mep[0]} and {mep[1]} but only {len(minima)} were found")
+            path = minimum_energy_path(X, Y, Z, minima[mep[0]][4:], minima[mep[1]][4:])
+        _plot_critical_points(found, path)
+        write_critical_points(found, path, plt_name)
+
     # Add labels and title
     print(f"Setting x axis label as {x_label}")
     plt.xlabel(x_label)
     print(f"Setting y axis label as {y_label}")
     plt.ylabel(y_label)
     print(f"Setting plot title as {plt_title}")
-    plt.title(plt_title + f"\n n_x_vals = {n_x_vals}, n_y_vals = {n_y_vals}, levels = {levels}")
+    num_levels = levels if np.isscalar(levels) else len(levels) - 1
+    plt.title(plt_title + f"\n n_x_vals = {n_x_vals}, n_y_vals = {n_y_vals}, levels = {num_levels}")
 
     # Add a colorbar
     print(f"Setting z axis (colorbar) label as {z_label}")
@@ -191,26 +723,188 @@ def generate_contour(x_input, y_input, energies, n_x_vals=None, n_y_vals=None,
         plt.show()
 
 
+def contour_slices(axes, grid, names, plot_axes, plt_name, levels=10, **contour_kwargs):
+    # Save a contour of every slice of an N-D scan grid through the scan values of the coordinates not in
+    # plot_axes. The slices share the global minimum as energy zero and the same levels so they can be compared
+    other = [axis for axis in range(grid.ndim) if axis not in plot_axes]
+    energy_reference = np.nanmin(grid)
+    shared_levels = np.linspace(0, (np.nanmax(grid) - energy_reference) * 627.509, levels + 1)
+    stem = os.path.splitext(plt_name)[0]
+
+    saved = []
+    for index in np.ndindex(*[len(axes[axis]) for axis in other]):
+        fixed = {axis: axes[axis][i] for axis, i in zip(other, index)}
+        remaining, slice_axes, slice_grid = slice_scan(axes, grid, fixed)
+        slice_axes, slice_grid = orient_slice(remaining, slice_axes, slice_grid, plot_axes)
+        tag = '_'.join(f"{names[axis]}={value:g}" for axis, value in fixed.items())
+        if np.count_nonzero(np.isfinite(slice_grid)) < 4:
+            print(f"Skipping slice {tag}, too few scan points")
+            continue
+
+        plt.figure()
+        generate_contour(scan_points(slice_axes), slice_grid.ravel(), levels=shared_levels,
+                         energy_reference=energy_reference, plt_save=True, plt_show=False,
+                         plt_name=f"{stem}_{tag}.pdf", **contour_kwargs)
+        plt.close()
+        saved.append(f"{stem}_{tag}.pdf")
+
+    print(f"Saved {len(saved)} slices")
+    return saved
+
+
+def reduce_scan(points, energies, names, plot_axes=(0, 1), fixed=None):
+    # Reduce a scan over any number of coordinates to the two plot_axes, slicing at the fixed {axis: value}
+    # coordinates or otherwise projecting the lowest energy. Returns the points, energies and a title suffix
+    axes, grid = scan_grid(points, energies)
+    if fixed:
+        remaining, slice_axes, slice_grid = slice_scan(axes, grid, fixed)
+        if sorted(remaining) != sorted(plot_axes):
+            raise ValueError(f"Fixed values are needed for every coordinate except {list(plot_axes)}")
+        slice_axes, slice_grid = orient_slice(remaining, slice_axes, slice_grid, plot_axes)
+        suffix = ", ".join(f"{names[axis]} = {value:g}" for axis, value in fixed.items())
+    else:
+        slice_axes, slice_grid = project_scan(axes, grid, plot_axes)
+        others = [name for axis, name in enumerate(names) if axis not in plot_axes]
+        suffix = f"lowest energy over {', '.join(others)}" if others else ""
+
+    return scan_points(slice_axes), slice_grid.ravel(), suffix
+
+
+def _fit_surface(points, energies, X, Y, interpolator="auto"):
+    # Energies of one column relative to their minimum in kcal/mol, interpolated onto the X, Y grid
+    clean_points, clean_z = _clean_data(points, energies)
+
+    interpolant = fit_interpolant(clean_points, clean_z, interpolator)
+    return evaluate_interpolant(interpolant, X, Y)
+
+
+def _plot_panels(X, Y, surfaces, titles, levels, cmap, x_label, y_label, z_label, plt_name):
+    # One contour panel per surface on shared axes and a single colour bar
+    num_cols = min(len(surfaces), 3)
+    num_rows = -(-len(surfaces) // num_cols)
+    fig, axs = plt.subplots(num_rows, num_cols, figsize=(4 * num_cols + 1, 3.5 * num_rows), sharex=True,
+                            sharey=True, squeeze=False, constrained_layout=True)
+
+    for ax, Z, title in zip(axs.flat, surfaces, titles):
+        contour = ax.contourf(X, Y, Z, levels=levels, cmap=cmap, alpha=0.9, extend='both')
+        ax.set_title(title)
+    for ax in axs.flat[len(surfaces):]:
+        ax.set_axis_off()
+    for ax in axs[-1]:
+        ax.set_xlabel(x_label)
+    for ax in axs[:, 0]:
+        ax.set_ylabel(y_label)
+    fig.colorbar(contour, ax=axs, label=z_label)
+
+    print(f"Saving plot as {os.getcwd()}/{plt_name}")
+    plt.savefig(plt_name, format="pdf")
+    plt.close(fig)
+
+
+def batch_contours(points, energies, column_names, n_x_vals=10, n_y_vals=10, levels=10, interp="auto",
+                   differences=None, workers=None, x_label=None, y_label=None, z_label=None, plt_name="plot.pdf"):
+    # Fit every energy column (n_points, n_columns) in parallel onto one common grid, then save all their
+    # contours with common levels, and the difference surfaces of the (column, column) index pairs in differences
+    stem = os.path.splitext(plt_name)[0]
+    scanned = points[np.isfinite(energies).any(axis=1)]
+    (x_min, y_min), (x_max, y_max) = scanned.min(axis=0), scanned.max(axis=0)
+    X, Y = np.meshgrid(np.linspace(x_min, x_max, n_x_vals), np.linspace(y_min, y_max, n_y_vals))
+
+    print(f"Fitting {energies.shape[1]} energy columns")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        surfaces = list(executor.map(_fit_surface, repeat(points), energies.T, repeat(X), repeat(Y), repeat(interp)))
+
+    lowest, highest = np.nanmin(surfaces), np.nanmax(surfaces)
+    shared_levels = np.linspace(lowest, max(highest, lowest + MIN_CONTOUR_RANGE), levels + 1)
+    _plot_panels(X, Y, surfaces, column_names, shared_levels, mpl.cm.bwr, x_label, y_label, z_label,
+                 f"{stem}_batch.pdf")
+
+    header = ["x", "y"] + list(column_names)
+    columns = [X.ravel(), Y.ravel()] + [Z.ravel() for Z in surfaces]
+    if differences:
+        diff_surfaces = [surfaces[a] - surfaces[b] for a, b in differences]
+        diff_names = [f"{column_names[a]} - {column_names[b]}" for a, b in differences]
+        bound = np.nanmax(np.abs(diff_surfaces))
+        # identical columns, or columns differing by a constant, give flat zero difference surfaces
+        if not bound > 0:
+            print("Difference surfaces are zero everywhere")
+            bound = MIN_CONTOUR_RANGE
+        _plot_panels(X, Y, diff_surfaces, diff_names, np.linspace(-bound, bound, levels + 1), mpl.cm.PuOr,
+                     x_label, y_label, z_label, f"{stem}_differences.pdf")
+        header += diff_names
+        columns += [Z.ravel() for Z in diff_surfaces]
+
+    print(f"Writing interpolated surfaces to {stem}_surfaces.csv")
+    with open(f"{stem}_surfaces.csv", mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(header)
+        writer.writerows(np.column_stack(columns))
+
+    return X, Y, surfaces
+
+
 if __name__ == '__main__':
 
     args = get_args()
     filename = args.filename
     column = args.column
-    energies = get_energies(filename, column)
     plotname = args.plotname
     n_x_vals = args.n_x_vals
     n_y_vals = args.n_y_vals
     levels = args.levels
-
-    x_input = [1.5, 2.1, 0.1]
-    y_input = [2.3, 1.1, -0.1]
-
-    generate_contour(x_input, y_input, energies,
+    x_label = "C–O / $\AA$"
+    y_label = "C-H / $\AA$"
+    z_label = "$\Delta$E / kcal mol$^{-1}$"
+    plt_title = "Concerted singlet O$_2$ insertion (UPBE0-D3BJ/def2-SVPD)"
+
+    # Scans over more than two coordinates are reduced to the --axes coordinates by slicing or projecting
+    # their N-D grid
+    plot_axes = args.axes
+    fixed = {int(axis): value for axis, value in args.fix} if args.fix else None
+
+    # Read every requested energy column at once and contour them side by side without a display
+    if args.batch is not None:
+        plt.switch_backend("Agg")
+        difference_columns = [c for pair in args.difference or [] for c in pair]
+        points, energies, names, columns, column_names = load_scan_columns(filename, args.batch, args.xy_columns,
+                                                                           args.scan_input, difference_columns)
+        if points.shape[1] > 2:
+            x_label, y_label = names[plot_axes[0]], names[plot_axes[1]]
+        if points.shape[1] > 2 or plot_axes != [0, 1]:
+            reduced = [reduce_scan(points, column_energies, names, plot_axes, fixed) for column_energies in energies.T]
+            points, energies = reduced[0][0], np.column_stack([scan[1] for scan in reduced])
+        batch_contours(points, energies, column_names, n_x_vals, n_y_vals, levels, args.interpolator,
+                       [(columns.index(a), columns.index(b)) for a, b in args.difference or []], args.workers,
+                       x_label, y_label, z_label, plotname + ".pdf")
+        raise SystemExit(0)
+
+    points, energies, names = load_scan(filename, column, args.xy_columns, args.scan_input)
+    if points.shape[1] > 2:
+        x_label, y_label = names[plot_axes[0]], names[plot_axes[1]]
+
+    if points.shape[1] > 2 or args.fix or args.project or args.all_slices or plot_axes != [0, 1]:
+        axes, grid = scan_grid(points, energies)
+        print(f"Scan grid of {' x '.join(str(len(axis)) for axis in axes)} points over {', '.join(names)}")
+
+        if args.all_slices:
+            contour_slices(axes, grid, names, plot_axes, plotname + ".pdf",
+                           levels=levels, n_x_vals=n_x_vals, n_y_vals=n_y_vals, interp=args.interpolator,
+                           x_label=x_label, y_label=y_label, z_label=z_label, plt_title=plt_title)
+            raise SystemExit(0)
+
+        if not fixed:
+            print(f"Projecting the lowest energy onto {names[plot_axes[0]]}, {names[plot_axes[1]]}")
+        points, energies, suffix = reduce_scan(points, energies, names, plot_axes, fixed)
+        if fixed:
+            plt_title += "\n" + suffix
+
+    generate_contour(points, energies,
                      n_x_vals=n_x_vals, n_y_vals=n_y_vals,
-                     levels=levels, interp="Rbf",
-                     x_label="C–O / $\AA$",
-                     y_label="C-H / $\AA$",
-                     z_label = "$\Delta$E / kcal mol$^{-1}$",
-                     plt_title="Concerted singlet O$_2$ insertion (UPBE0-D3BJ/def2-SVPD)",
+                     levels=levels, interp=args.interpolator,
+                     x_label=x_label,
+                     y_label=y_label,
+                     z_label=z_label,
+                     plt_title=plt_title,
                      plt_save=args.save, plt_show=args.plot,
-                     plt_name=plotname+".pdf")
+                     plt_name=plotname+".pdf", interpolant_file=args.interpolant,
+                     critical_points=args.critical_points, mep=args.mep)
@@ -1,8 +1,46 @@
 import sys
-import re
 import numpy as np
 import matplotlib.pyplot as plt
 import argparse
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from analysis_core import CACHE_DIR, CACHE_SIZE, cache_key, load_from_cache, save_to_cache
+from analysis_core import load_frame_index, index_hashes, index_matches, save_index, read_frame_comments
+from analysis_core import cell_matrix, extract_distances
+from analysis_core import autocorrelation, power_spectrum, dominant_frequencies
+
+
+# Per-step quantities extracted from Q-Chem AIMD outputs
+QCHEM_FIELDS = ('time', 'energy', 'temperature', 'kinetic_energy', 'scf_cycles', 'scf_time', 'step_time')
+QCHEM_PREFIXES = (b'Total energy in the final basis set', b'Instantaneous Temperature', b'Kinetic energy',
+                  b'Kinetic Energy', b'SCF time:', b'Time for this dynamics step:')
+
+# Panels of the overlaid --multi figures for each type of input: (quantity, y axis label, title)
+MULTI_PANELS = {
+    'out': [('rel_energy', "Rel. Energy (kcal/mol)", "Time Step vs Rel. Electronic Energy"),
+            ('temperature', "Inst. Temperature (K)", "Time Step vs Instantaneous Temperature"),
+            ('diff_rel_energy', "Seq. Diff. Rel. Energy (kcal/mol)", "Time Step vs Diff Relative Electronic Energy"),
+            ('diff_temperature', "Seq. Diff. Inst. Temp. (K)", "Time Step vs Diff Instantaneous Temperature")],
+    'energy': [('diff_rel_energy', "Diff. Rel. Energy (kcal/mol)", "Time Step vs Seq. Diff. Rel. Energy"),
+               ('delta_rel_energy', "Delta Rel. Energy (kcal/mol)", "Time Step vs Delta Relative Energy")],
+    'tandv': [('pe_total', "Abs PE (Ha)", "Time Step vs Potential Energy"),
+              ('ke_total', "Abs KE (Ha)", "Time Step vs Kinetic Energy"),
+              ('pe_rel', "Rel PE (kcal/mol)", "Time Step vs Delta Potential Energy"),
+              ('ke_rel', "Rel KE (kcal/mol)", "Time Step vs Delta Kinetic Energy")],
+    'xyz': [('distance', "Distance ($\\AA$)", "Time Step vs Distance")],
+}
+MAX_LEGEND_ENTRIES = 10
+
+# Energy conservation and thermostat screening, a run is flagged when any diagnostic exceeds its threshold
+DIAGNOSTIC_WINDOW = 100  # steps
+DIAGNOSTIC_THRESHOLDS = {
+    'max_window_drift': 1.0,  # kcal/mol/ps, largest windowed drift of the total energy
+    'max_energy_jump': 10.0,  # kcal/mol, largest change of the total energy between consecutive steps
+    'temperature_fluctuation': 0.25,  # standard deviation / mean of the temperature
+    'max_temperature': 2000.0,  # K
+}
 
 
 def get_args():
@@ -16,190 +54,282 @@ def get_args():
                            action='store',
                            type=int,
                            help="Specify index of pair of atoms to calculate distance between them, 1-indexed")
+    my_parser.add_argument("-c", "--cell",
+                           nargs='+',
+                           type=float,
+                           help="Periodic cell as a b c, a b c alpha beta gamma or the 9 lattice vector components, in A")
     my_parser.add_argument("-m", "--multi",
                            action='store_true',
                            help="Process multiple files and overlay plots")
-    return my_parser.parse_args()
+    my_parser.add_argument("-j", "--workers",
+                           type=int,
+                           default=None,
+                           help="Number of processes used to parse files with --multi, defaults to all cores")
+    my_parser.add_argument("-o", "--output",
+                           type=str,
+                           default="multi",
+                           help="Prefix of the files written with --multi and --diagnostics")
+    my_parser.add_argument("-s", "--steps",
+                           nargs=2,
+                           type=int,
+                           default=(0, None),
+                           metavar=('START', 'STOP'),
+                           help="Only analyze TIME STEP sections START to STOP (exclusive, 0-indexed) of .out files")
+    my_parser.add_argument("--float32",
+                           action='store_true',
+                           help="Keep the relative energies derived from Energy and TandV tables in float32, the tables stay float64")
+    my_parser.add_argument("--cache_dir",
+                           type=str,
+                           default=CACHE_DIR,
+                           help="Directory of the cache of parsed Energy and TandV tables and xyz distances")
+    my_parser.add_argument("--no_cache",
+                           action='store_true',
+                           help="Parse Energy and TandV tables and xyz files without reading or writing the cache")
+    my_parser.add_argument("--spectra",
+                           action='store_true',
+                           help="Plot the autocorrelation functions and power spectra of the energy and temperature of .out files, "
+                                "also with --multi")
+    my_parser.add_argument("-d", "--diagnostics",
+                           action='store_true',
+                           help="Screen .out and TandV files for energy drift and temperature blow-ups, "
+                                "writing one row per file to <output>_diagnostics.csv")
+    my_parser.add_argument("--window",
+                           type=int,
+                           default=DIAGNOSTIC_WINDOW,
+                           help="Number of steps in the rolling windows of --diagnostics")
+    my_parser.add_argument("--drift_threshold",
+                           type=float,
+                           default=DIAGNOSTIC_THRESHOLDS['max_window_drift'],
+                           help="Flag runs whose windowed total energy drift exceeds this, in kcal/mol/ps")
+    my_parser.add_argument("--jump_threshold",
+                           type=float,
+                           default=DIAGNOSTIC_THRESHOLDS['max_energy_jump'],
+                           help="Flag runs whose total energy changes by more than this in one step, in kcal/mol")
+    my_parser.add_argument("--fluctuation_threshold",
+                           type=float,
+                           default=DIAGNOSTIC_THRESHOLDS['temperature_fluctuation'],
+                           help="Flag runs whose temperature standard deviation / mean exceeds this")
+    my_parser.add_argument("--max_temperature",
+                           type=float,
+                           default=DIAGNOSTIC_THRESHOLDS['max_temperature'],
+                           help="Flag runs whose temperature exceeds this, in K")
+    args = my_parser.parse_args()
+
+    if args.spectra and args.diagnostics:
+        my_parser.error("--spectra cannot be combined with --diagnostics")
+    return args
 
 
 def _get_relative_energies(energies):
     # Input numpy array, find minimum energy, normalize all energies to
     # lowest energy in kcal/mol
-    min_energy = np.min(energies)
+    min_energy = np.nanmin(energies)
     rel_energies = (energies - min_energy) * 627.509
 
     return rel_energies
 
 
-def extract_energy_from_sections(filename, debug=False):
-    # Initialize variables to keep track of the current section
+def _value_after(line, separator):
+    # First number after the separator, e.g. b"Instantaneous Temperature =  298.15 K" -> 298.15
+    return float(line.split(separator, 1)[1].split()[0].rstrip(b's'))
+
+
+def _grow_arrays(data, capacity):
+    for name, values in data.items():
+        grown = np.full(capacity, np.nan)
+        grown[:len(values)] = values
+        data[name] = grown
+
+    return data
+
+
+def _parse_qchem_sections(filename, position=0, first_step=0, debug=False):
+    # Single pass over a Q-Chem AIMD output from byte position onwards. Each TIME STEP # section fills one row
+    # of the per-step arrays, dispatching on the start of each line, and any quantity missing from a section
+    # is left as NaN. Only complete sections are returned, with the byte offset of each and the end of the last
+    # one, so that parsing resumes there once the rest of a running output has been written
+    capacity = 1024
+    data = _grow_arrays({name: np.empty(0) for name in QCHEM_FIELDS}, capacity)
+    offsets = []
+    complete_end = position
+    num_complete = 0
+    step = -1
     in_section = False
-    section_lines = []
-    time_step_found = False
-    energy_found = False
-    inst_temp_found = False
-
-    time_step = []
-    energies = []
-    inst_temp = []
-
-    # Define the regular expression patterns
-    section_start_pattern = r"TIME STEP #"
-    section_end_pattern = r"Time for this dynamics step:"
-    energy_pattern = r"Total energy in the final basis set =\s+(-?\d+\.\d+)"
-    inst_temp_pattern = r"Instantaneous Temperature =\s+(-?\d+\.\d+)"
-
-    with open(filename, 'r') as file:
+
+    with open(filename, 'rb') as file:
+        file.seek(position)
         for line in file:
-            # Check for the start of a new section
-            if re.search(section_start_pattern, line):
+            # a line without its newline is still being written
+            if not line.endswith(b'\n'):
+                break
+            line_start = position
+            position += len(line)
+            stripped = line.lstrip()
+            if stripped.startswith(b'TIME STEP #'):
+                step += 1
                 in_section = True
-                section_lines = []
-                time_step_value = line.strip().split()[8]
-                if debug == True:
-                    print(f"Time step value in this section: {time_step_value} fs")
-                time_step.append(time_step_value)
-                time_step_found = True
-
-            if in_section:
-                section_lines.append(line)
-
-                # Check for the end of the section
-                if re.search(section_end_pattern, line):
-                    in_section = False
-
-                    # Search for the energy line within the section
-                    for section_line in section_lines:
-                        energy_match = re.search(energy_pattern, section_line)
-                        if energy_match:
-                            energy_value = energy_match.group(1).strip().split()
-                            if debug == True:
-                                print(f"Energy in this section: {energy_value[0]} Ha")
-                            energies.append(energy_value)
-                            energy_found = True
-                    # Search for the instantaneous temperature line within the section
-                    for section_line in section_lines:
-                        inst_temp_match = re.search(inst_temp_pattern, section_line)
-                        if inst_temp_match:
-                            inst_temp_value = str(inst_temp_match.group(1))
-                            if debug == True:
-                                print(f"Instantaneous temperature in this section: {inst_temp_value} K")
-                                print("---------------------------------------------------")
-                            inst_temp.append(inst_temp_value)
-                            inst_temp_found = True
-
-                    if not time_step_found:
-                        print("Time step not found")
-                        energies.append("NaN")
-                    if not energy_found:
-                        print("Energy not found")
-                        energies.append("NaN")
-                    if not inst_temp_found:
-                        print("Instantaneous temperature not found")
-                        inst_temp.append("NaN")
-
-    time_step = np.array(time_step, dtype='float').T
-    energies = np.array(energies, dtype='float').T[0]
-    inst_temp = np.array(inst_temp, dtype='float').T
-
-    rel_energies = _get_relative_energies(energies)
-
-    # sim_data = np.column_stack((time_step, rel_energies, inst_temp))
-
-    return time_step, rel_energies, inst_temp
-
-
-def extract_energy_from_energy_file(filename):
-    # Initialize an empty list to store the data
-    data = []
-
-    # Open the file and read its contents
-    with open(filename, 'r') as file:
-        # Skip the first line (header)
-        next(file)
-        for line in file:
-            # Split the line into values and convert them to floats
-            values = [float(val) for val in line.split()]
-            data.append(values)
-
-    # Create a numpy array from the extracted data
-    arr = np.array(data)
+                if step == capacity:
+                    capacity *= 2
+                    _grow_arrays(data, capacity)
+                offsets.append(line_start)
+                data['time'][step] = float(stripped.split()[8])
+                continue
+
+            if not in_section:
+                continue
+
+            if stripped[:1].isdigit():
+                # SCF iteration line, the last one of a converged SCF carries the number of cycles
+                if stripped.rstrip().endswith(b'Convergence criterion met'):
+                    data['scf_cycles'][step] = int(stripped.split()[0])
+            elif not stripped.startswith(QCHEM_PREFIXES):
+                continue
+            elif stripped.startswith(b'Total energy in the final basis set'):
+                data['energy'][step] = _value_after(stripped, b'=')
+            elif stripped.startswith(b'Instantaneous Temperature'):
+                data['temperature'][step] = _value_after(stripped, b'=')
+            elif stripped.startswith((b'Kinetic energy', b'Kinetic Energy')):
+                data['kinetic_energy'][step] = _value_after(stripped, b'=')
+            elif stripped.startswith(b'SCF time:'):
+                data['scf_time'][step] = _value_after(stripped, b'wall')
+            elif stripped.startswith(b'Time for this dynamics step:'):
+                data['step_time'][step] = _value_after(stripped, b':')
+                in_section = False
+                complete_end = position
+                num_complete = step + 1
+                if debug:
+                    print(f"Step {first_step + step}: t = {data['time'][step]} fs, E = {data['energy'][step]} Ha, "
+                          f"T = {data['temperature'][step]} K")
+
+    data = {name: values[:num_complete] for name, values in data.items()}
+
+    return data, np.array(offsets[:num_complete], dtype=np.int64), complete_end
+
+
+def load_qchem_index(filename, debug=False):
+    # Byte offset and parsed values of every complete TIME STEP # section, saved next to the output as
+    # <out>.idx.npz and extended from the last complete section when the output grows. A section still
+    # being written is left out and parsed again on the next call
+    index_path = f'{filename}.idx.npz'
+    size = os.path.getsize(filename)
+
+    index = None
+    if os.path.isfile(index_path):
+        with np.load(index_path) as data:
+            index = {name: data[name] for name in data.files}
+        if not index_matches(filename, index):
+            print(f"Step index {index_path} is out of date, rebuilding")
+            index = None
+
+    if index is None:
+        print(f"Building step index for {filename}")
+        index = {'offsets': np.empty(0, dtype=np.int64), 'end': 0}
+        index.update(index_hashes(filename, 0, 0))
+        index.update({name: np.empty(0) for name in QCHEM_FIELDS})
+
+    if size > int(index['end']):
+        data, offsets, end = _parse_qchem_sections(filename, int(index['end']), len(index['offsets']), debug)
+        if len(offsets):
+            index['offsets'] = np.concatenate((index['offsets'], offsets))
+            for name in QCHEM_FIELDS:
+                index[name] = np.concatenate((index[name], data[name]))
+            index['end'] = end
+            index.update(index_hashes(filename, 0, end))
+            save_index(filename, index)
+
+    return index
+
+
+def parse_qchem_aimd(filename, debug=False, start_step=0, stop_step=None):
+    # Per-step arrays of the TIME STEP # sections start_step:stop_step, using the step index so that only
+    # output appended since the last call is parsed
+    index = load_qchem_index(filename, debug)
+    data = {name: index[name][start_step:stop_step] for name in QCHEM_FIELDS}
+
+    num_steps = len(data['time'])
+    for name, values in data.items():
+        num_missing = np.count_nonzero(np.isnan(values))
+        if num_missing and name in ('time', 'energy', 'temperature'):
+            print(f"{name} not found in {num_missing} of {num_steps} time steps")
+
+    return data
+
+
+def read_qchem_steps(filename, start_step=0, stop_step=None):
+    # Raw text of the TIME STEP # sections start_step:stop_step, read straight from their byte offsets
+    index = load_qchem_index(filename)
+    offsets = np.append(index['offsets'], int(index['end']))
+    num_steps = len(index['offsets'])
+    start, stop, _ = slice(start_step, stop_step).indices(num_steps)
+    if start >= stop:
+        return ''
+
+    with open(filename, 'rb') as file:
+        file.seek(offsets[start])
+        return file.read(offsets[stop] - offsets[start]).decode()
+
+
+def extract_energy_from_sections(filename, debug=False, start_step=0, stop_step=None):
+    data = parse_qchem_aimd(filename, debug, start_step, stop_step)
+    rel_energies = _get_relative_energies(data['energy'])
+
+    return data['time'], rel_energies, data['temperature']
+
+
+def load_table(filename, cache_dir=CACHE_DIR, cache_size=CACHE_SIZE):
+    # Whole whitespace separated table below the header line in one vectorized read. The table is kept in
+    # float64, since its energies are absolute Hartree values, in the same cache as the trajectory distances
+    # under its own key, and later loads are copy-on-write memory maps
+    key = cache_key(filename, 0, None, 1, tag='table') if cache_dir is not None else None
+    if key is not None:
+        table = load_from_cache(cache_dir, key, 'table', mmap_mode='c')
+        if table is not None:
+            return table
+
+    table = np.loadtxt(filename, skiprows=1, dtype=np.float64, ndmin=2)
+    if key is not None:
+        save_to_cache(cache_dir, key, 'table', table, cache_size)
+
+    return table
+
+
+def extract_energy_from_energy_file(filename, dtype=np.float64, cache_dir=CACHE_DIR):
+    # Only the relative energies converted to kcal/mol are stored in dtype
+    arr = load_table(filename, cache_dir)
 
     time_steps = arr[:, 0]
-    diff_rel_energies = arr[:, 1]*627.509
-    delta_rel_energies = arr[:, 2]*627.509
+    diff_rel_energies = (arr[:, 1] * 627.509).astype(dtype)
+    delta_rel_energies = (arr[:, 2] * 627.509).astype(dtype)
 
     return time_steps, diff_rel_energies, delta_rel_energies
 
 
-def extract_data_from_tandv_file(filename):
-    # Initialize an empty list to store the data
-    data = []
-
-    # Open the file and read its contents
-    with open(filename, 'r') as file:
-        # Skip the first line (header)
-        next(file)
-        for line in file:
-            # Split the line into values and convert them to floats
-            values = [float(val) for val in line.split()]
-            data.append(values)
-
-    # Create a numpy array from the extracted data
-    arr = np.array(data)
+def extract_data_from_tandv_file(filename, dtype=np.float64, cache_dir=CACHE_DIR):
+    # The total energies stay float64, only the relative energies converted to kcal/mol are stored in dtype
+    arr = load_table(filename, cache_dir)
 
     time_steps = arr[:, 0]
     pe_total = arr[:, 1]
     ke_total = arr[:, 2]
-    pe_rel = arr[:, 3]*627.509
-    ke_rel = arr[:, 4]*627.509
+    pe_rel = (arr[:, 3] * 627.509).astype(dtype)
+    ke_rel = (arr[:, 4] * 627.509).astype(dtype)
 
     return time_steps, pe_total, ke_total, pe_rel, ke_rel
 
 
-def extract_data_from_xyz_file(filename, atom1, atom2):
-    coords = read_coordinates(filename)
-    distances_array = calculate_distance(coords, atom1, atom2)
-
-    return distances_array
-
-
-def read_coordinates(filename, atom1, atom2):
-    distances = []
-    atom1_type = []
-    atom2_type = []
-
-    with open(filename, 'r') as file:
-        lines = file.readlines()
-
-    i = 0
-    while i < len(lines):
-        if lines[i].strip().isdigit():
-            num_atoms = int(lines[i])
-            time_step = float(lines[i + 1].strip())
-            i += 2
-            current_coords = []
-            current_atom_types = []
-
-            for j in range(num_atoms):
-                atom_types = [str(coord) for coord in lines[i].split()[0]]
-                coords = [float(coord) for coord in lines[i].split()[1:]]
-                current_atom_types.append(atom_types)
-                current_coords.append(coords)
-                i += 1
-
-            # switched atom numbering from 1-index to 0-index
-            if len(current_coords) == num_atoms:
-                atom1_type = current_atom_types[atom1-1]
-                atom2_type = current_atom_types[atom2-1]
-                atom1_coords = current_coords[atom1-1]
-                atom2_coords = current_coords[atom2-1]
-                distance = np.linalg.norm(np.array(atom1_coords) - np.array(atom2_coords))
-                distances.append((time_step, distance))
-        else:
-            i += 1
+def extract_data_from_xyz_file(filename, atom1, atom2, cell=None, cache_dir=CACHE_DIR):
+    time_distances_array, atom1_type, atom2_type = read_coordinates(filename, atom1, atom2, cell, cache_dir)
+
+    return time_distances_array
+
 
-    return np.array(distances), str(atom1_type[0]), str(atom2_type[0])
+def read_coordinates(filename, atom1, atom2, cell=None, cache_dir=CACHE_DIR):
+    # Distances come from the shared indexed, cached reader, the times from the comment line of each frame
+    sim_list, distances_array, symbols = extract_distances(filename, [(atom1, atom2)], cache_dir=cache_dir, cell=cell)
+    index = load_frame_index(filename)
+    time_steps = np.array(read_frame_comments(filename, index, sim_list), dtype=float)
+
+    return np.column_stack((time_steps, distances_array[0])), str(symbols[atom1-1]), str(symbols[atom2-1])
 
 
 def calc_diffs(rel_energies, inst_temp):
@@ -211,6 +341,165 @@ def calc_diffs(rel_energies, inst_temp):
     return diff_rel_energies, diff_inst_temp
 
 
+def _window_sums(values, window):
+    # Sum over the trailing window of every step with a full window, from one cumulative sum
+    cumulative = np.concatenate(([0.0], np.cumsum(values)))
+
+    return cumulative[window:] - cumulative[:-window]
+
+
+def rolling_mean_std(values, window):
+    # O(n) rolling mean and standard deviation over the trailing window of each step, NaN for steps without
+    # a full window or whose window contains a missing value
+    values = np.asarray(values, dtype=float)
+    mean = np.full(len(values), np.nan)
+    std = np.full(len(values), np.nan)
+    if len(values) < window:
+        return mean, std
+
+    # centre the series so that the sums of squares do not lose precision
+    finite = np.isfinite(values)
+    centred = np.where(finite, values - np.nanmean(values), 0.0)
+    counts = _window_sums(finite, window)
+    sums = _window_sums(centred, window)
+    squares = _window_sums(centred ** 2, window)
+
+    complete = counts == window
+    mean[window - 1:] = np.where(complete, sums / window + np.nanmean(values), np.nan)
+    std[window - 1:] = np.where(complete, np.sqrt(np.maximum(squares / window - (sums / window) ** 2, 0.0)), np.nan)
+
+    return mean, std
+
+
+def rolling_drift(time_steps, values, window):
+    # Slope of a least squares line through the trailing window of each step in units of values per ps,
+    # from cumulative sums assuming a constant time step
+    values = np.asarray(values, dtype=float)
+    drift = np.full(len(values), np.nan)
+    if len(values) < window or window < 2:
+        return drift
+
+    finite = np.isfinite(values)
+    centred = np.where(finite, values - np.nanmean(values), 0.0)
+    steps = np.arange(len(values))
+    counts = _window_sums(finite, window)
+    sums = _window_sums(centred, window)
+    weighted_sums = _window_sums(steps * centred, window)
+
+    # sum of (i - mean i) * v_i within each window, and sum of (i - mean i)^2 for i = 0..window-1
+    window_starts = steps[:len(sums)]
+    covariance = weighted_sums - (window_starts + (window - 1) / 2) * sums
+    variance = window * (window ** 2 - 1) / 12
+    time_step = np.median(np.diff(time_steps))
+    drift[window - 1:] = np.where(counts == window, covariance / variance / time_step * 1000, np.nan)
+
+    return drift
+
+
+def energy_diagnostics(time_steps, total_energies, temperatures=None, window=DIAGNOSTIC_WINDOW):
+    # Energy conservation and temperature fluctuation statistics of one run, energies in kcal/mol, time in fs
+    finite = np.isfinite(total_energies)
+    energy_mean, energy_std = rolling_mean_std(total_energies, window)
+    window_drift = rolling_drift(time_steps, total_energies, window)
+    if np.count_nonzero(finite) > 1:
+        overall_drift = np.polyfit(time_steps[finite], total_energies[finite], 1)[0] * 1000
+    else:
+        overall_drift = np.nan
+
+    diagnostics = {
+        'steps': len(time_steps),
+        'simulation_time': time_steps[-1] - time_steps[0] if len(time_steps) else 0.0,
+        'overall_drift': overall_drift,
+        'max_window_drift': np.nanmax(np.abs(window_drift)) if np.any(np.isfinite(window_drift)) else np.nan,
+        'max_window_energy_std': np.nanmax(energy_std) if np.any(np.isfinite(energy_std)) else np.nan,
+        'max_energy_jump': np.nanmax(np.abs(np.diff(total_energies))) if np.count_nonzero(finite) > 1 else np.nan,
+        'mean_temperature': np.nan,
+        'temperature_std': np.nan,
+        'temperature_fluctuation': np.nan,
+        'max_temperature': np.nan,
+        'max_window_temperature_std': np.nan,
+    }
+
+    if temperatures is not None and np.any(np.isfinite(temperatures)):
+        temperature_std = rolling_mean_std(temperatures, window)[1]
+        diagnostics['mean_temperature'] = np.nanmean(temperatures)
+        diagnostics['temperature_std'] = np.nanstd(temperatures)
+        diagnostics['temperature_fluctuation'] = diagnostics['temperature_std'] / diagnostics['mean_temperature']
+        diagnostics['max_temperature'] = np.nanmax(temperatures)
+        if np.any(np.isfinite(temperature_std)):
+            diagnostics['max_window_temperature_std'] = np.nanmax(temperature_std)
+
+    return diagnostics, {'energy_mean': energy_mean, 'energy_std': energy_std, 'window_drift': window_drift}
+
+
+def diagnose_aimd_file(filename, window=DIAGNOSTIC_WINDOW, steps=(0, None), dtype=np.float64, cache_dir=CACHE_DIR):
+    # Diagnostics of the total (potential + kinetic) energy relative to the first step, potential only
+    # when the output has no kinetic energies. None for files without energies
+    basename = os.path.basename(filename)
+
+    if filename.endswith(".out"):
+        data = parse_qchem_aimd(filename, False, *steps)
+        time_steps, temperatures = data['time'], data['temperature']
+        total_energies = data['energy']
+        if np.any(np.isfinite(data['kinetic_energy'])):
+            total_energies = total_energies + data['kinetic_energy']
+
+    elif basename.startswith("TandV"):
+        time_steps, pe_total, ke_total, pe_rel, ke_rel = extract_data_from_tandv_file(filename, dtype, cache_dir)
+        total_energies = np.asarray(pe_total, dtype=float) + ke_total
+        temperatures = None
+
+    else:
+        return None
+
+    if not np.any(np.isfinite(total_energies)):
+        return None
+    total_energies = (total_energies - total_energies[np.isfinite(total_energies)][0]) * 627.509
+
+    return energy_diagnostics(np.asarray(time_steps, dtype=float), total_energies, temperatures, window)[0]
+
+
+def flag_diagnostics(diagnostics, thresholds=DIAGNOSTIC_THRESHOLDS):
+    return [name for name, threshold in thresholds.items() if diagnostics[name] > threshold]
+
+
+def run_diagnostics(filenames, workers=None, output_name="multi", window=DIAGNOSTIC_WINDOW,
+                    thresholds=DIAGNOSTIC_THRESHOLDS, steps=(0, None), dtype=np.float64, cache_dir=CACHE_DIR):
+    # Screen every .out and TandV file concurrently and write one row of diagnostics per run
+    filenames = [name for name in filenames if not name.endswith(".pdf")]
+    print(f"Running diagnostics on {len(filenames)} files")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(diagnose_aimd_file, filenames, repeat(window), repeat(steps),
+                                    repeat(dtype), repeat(cache_dir)))
+
+    diagnostics_file_path = f"{output_name}_diagnostics.csv"
+    print(f"Writing diagnostics to {diagnostics_file_path}")
+    num_flagged = 0
+    with open(diagnostics_file_path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["File", "Steps", "Time (fs)", "Drift (kcal/mol/ps)", "Max window drift (kcal/mol/ps)",
+                         "Max window energy std (kcal/mol)", "Max energy jump (kcal/mol)", "Mean T (K)",
+                         "Std T (K)", "T fluctuation", "Max T (K)", "Max window T std (K)", "Flags"])
+        for name, diagnostics in zip(filenames, results):
+            if diagnostics is None:
+                print(f"Skipping {name}")
+                continue
+            flags = flag_diagnostics(diagnostics, thresholds)
+            if flags:
+                num_flagged += 1
+                print(f"{name} flagged: {', '.join(flags)}")
+            writer.writerow([name, diagnostics['steps'], diagnostics['simulation_time'], diagnostics['overall_drift'],
+                             diagnostics['max_window_drift'], diagnostics['max_window_energy_std'],
+                             diagnostics['max_energy_jump'], diagnostics['mean_temperature'],
+                             diagnostics['temperature_std'], diagnostics['temperature_fluctuation'],
+                             diagnostics['max_temperature'], diagnostics['max_window_temperature_std'],
+                             ';'.join(flags)])
+
+    print(f"{num_flagged} of {len(filenames)} files flagged")
+
+    return results
+
+
 def plot_data_from_out(time_steps, relative_energies, temperatures, delta_relative_energies, delta_temperatures, filename):
 
     # Create a figure with subplots
@@ -251,6 +540,37 @@ def plot_data_from_out(time_steps, relative_energies, temperatures, delta_relati
     plt.show()
 
 
+def plot_spectra_from_out(time_steps, relative_energies, temperatures, filename):
+    # Autocorrelation and power spectrum of the energy and temperature series from one batched FFT
+    series = np.vstack((relative_energies, temperatures))
+    time_step = np.median(np.diff(time_steps))
+    acf = autocorrelation(series)
+    frequencies, power = power_spectrum(series, time_step)
+    lags = np.arange(acf.shape[1]) * time_step
+
+    labels = ['Rel. Energy', 'Inst. Temperature']
+    for label, frequency in zip(labels, dominant_frequencies(frequencies, power)):
+        print(f"{filename} {label} dominant frequency: {frequency:.1f} cm-1")
+
+    fig, axs = plt.subplots(1, 2, figsize=(12, 5))
+    for i, label in enumerate(labels):
+        axs[0].plot(lags, acf[i], label=label)
+        axs[1].plot(frequencies, power[i] / np.max(power[i], initial=1e-300), label=label)
+    axs[0].set_xlabel("Lag (fs)")
+    axs[0].set_ylabel("Autocorrelation")
+    axs[0].set_title("Autocorrelation Functions")
+    axs[1].set_xlabel("Frequency (cm$^{-1}$)")
+    axs[1].set_ylabel("Normalised Power")
+    axs[1].set_title("Power Spectra")
+    axs[0].legend()
+    axs[1].legend()
+
+    plt.tight_layout()
+    plt.savefig(f"{filename}_spectra.pdf", format="pdf")
+    plt.show()
+    plt.close(fig)
+
+
 def plot_data_from_energy(time_steps, diff_relative_energies, delta_relative_energies, filename):
 
     # Create a figure with subplots
@@ -327,12 +647,116 @@ def plot_data_from_xyz(time_distances_array, atom1, atom2, atom1_type, atom2_typ
     plt.show()
 
 
+def load_aimd_file(filename, atom_pair=None, cell=None, steps=(0, None), dtype=np.float64, cache_dir=CACHE_DIR):
+    # Parse one input file into its type and a dict of per-step arrays, (None, None) for unsupported files
+    basename = os.path.basename(filename)
+
+    if filename.endswith(".out"):
+        time_step, rel_energies, inst_temp = extract_energy_from_sections(filename, False, *steps)
+        diff_rel_energies, diff_inst_temp = calc_diffs(rel_energies, inst_temp)
+        return 'out', {'time': time_step, 'rel_energy': rel_energies, 'temperature': inst_temp,
+                       'diff_rel_energy': diff_rel_energies, 'diff_temperature': diff_inst_temp}
+
+    elif basename.startswith("Energy"):
+        time_step, diff_rel_energies, delta_rel_energies = extract_energy_from_energy_file(filename, dtype, cache_dir)
+        return 'energy', {'time': time_step, 'diff_rel_energy': diff_rel_energies, 'delta_rel_energy': delta_rel_energies}
+
+    elif basename.startswith("TandV"):
+        time_steps, pe_total, ke_total, pe_rel, ke_rel = extract_data_from_tandv_file(filename, dtype, cache_dir)
+        return 'tandv', {'time': time_steps, 'pe_total': pe_total, 'ke_total': ke_total, 'pe_rel': pe_rel, 'ke_rel': ke_rel}
+
+    elif filename.endswith(".xyz") and atom_pair is not None:
+        time_distances_array, atom1_type, atom2_type = read_coordinates(filename, atom_pair[0], atom_pair[1], cell, cache_dir)
+        return 'xyz', {'time': time_distances_array[:, 0], 'distance': time_distances_array[:, 1]}
+
+    return None, None
+
+
+def plot_multi(results, kind, output_name):
+    # Overlay every file of one type on a shared figure
+    panels = MULTI_PANELS[kind]
+    num_cols = min(len(panels), 2)
+    num_rows = -(-len(panels) // num_cols)
+    fig, axs = plt.subplots(num_rows, num_cols, figsize=(6 * num_cols, 5 * num_rows), squeeze=False)
+
+    for ax, (series, y_label, title) in zip(axs.flat, panels):
+        for name, data in results:
+            ax.plot(data['time'], data[series], label=name, linewidth=0.8)
+        ax.set_xlabel("Time Step (fs)")
+        ax.set_ylabel(y_label)
+        ax.set_title(title)
+        if len(results) <= MAX_LEGEND_ENTRIES:
+            ax.legend(fontsize='small')
+
+    plt.tight_layout()
+    plt.savefig(f"{output_name}_{kind}.pdf", format="pdf")
+    plt.close(fig)
+
+
+def write_multi_summary(results_by_kind, summary_file_path):
+    # One row per file and quantity
+    print(f"Writing summary of all files to {summary_file_path}")
+    with open(summary_file_path, mode='w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["File", "Type", "Quantity", "Steps", "Mean", "Std dev", "Min", "Max"])
+        for kind, results in results_by_kind.items():
+            for name, data in results:
+                for series, values in data.items():
+                    if series == 'time' or len(values) == 0:
+                        continue
+                    writer.writerow([name, kind, series, len(values), np.nanmean(values), np.nanstd(values),
+                                     np.nanmin(values), np.nanmax(values)])
+
+
+def run_multi(filenames, atom_pair=None, cell=None, workers=None, output_name="multi", steps=(0, None),
+              dtype=np.float64, cache_dir=CACHE_DIR, spectra=False):
+    # Parse every input concurrently, then overlay each type of input on shared figures
+    filenames = [name for name in filenames if not name.endswith(".pdf")]
+    print(f"Parsing {len(filenames)} files")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        loaded = list(executor.map(load_aimd_file, filenames, repeat(atom_pair), repeat(cell), repeat(steps),
+                                   repeat(dtype), repeat(cache_dir)))
+
+    results_by_kind = {}
+    for name, (kind, data) in zip(filenames, loaded):
+        if kind is None:
+            print(f"Skipping {name}")
+            continue
+        results_by_kind.setdefault(kind, []).append((name, data))
+
+    for kind, results in results_by_kind.items():
+        print(f"Plotting {len(results)} {kind} files")
+        plot_multi(results, kind, output_name)
+
+    if spectra:
+        for name, data in results_by_kind.get('out', []):
+            plot_spectra_from_out(data['time'], data['rel_energy'], data['temperature'], os.path.splitext(name)[0])
+
+    write_multi_summary(results_by_kind, f"{output_name}_summary.csv")
+
+    return results_by_kind
+
+
 if __name__ == "__main__":
 
     args = get_args()
     filename = args.filename
     do_multi = args.multi
-    print(do_multi)
+    dtype = np.float32 if args.float32 else np.float64
+    cache_dir = None if args.no_cache else args.cache_dir
+
+    if args.diagnostics:
+        thresholds = {'max_window_drift': args.drift_threshold, 'max_energy_jump': args.jump_threshold,
+                      'temperature_fluctuation': args.fluctuation_threshold, 'max_temperature': args.max_temperature}
+        run_diagnostics(filename, args.workers, args.output, args.window, thresholds, args.steps, dtype, cache_dir)
+        filename = []
+
+    elif do_multi:
+        # Render headless so that nothing blocks on GUI windows
+        plt.switch_backend("Agg")
+        cell = cell_matrix(args.cell) if args.cell is not None else None
+        run_multi(filename, args.atom_pair, cell, args.workers, args.output, args.steps, dtype, cache_dir, args.spectra)
+        filename = []
 
     for i in range(len(filename)):
 
@@ -340,22 +764,25 @@ if __name__ == "__main__":
             continue
 
         elif filename[i].endswith(".out"):
-            time_step, rel_energies, inst_temp = extract_energy_from_sections(filename[i], debug=False)
+            time_step, rel_energies, inst_temp = extract_energy_from_sections(filename[i], False, *args.steps)
             diff_rel_energies, diff_inst_temp = calc_diffs(rel_energies, inst_temp)
             plot_data_from_out(time_step, rel_energies, inst_temp, diff_rel_energies, diff_inst_temp, filename[i].strip(".out"))
+            if args.spectra:
+                plot_spectra_from_out(time_step, rel_energies, inst_temp, filename[i].strip(".out"))
 
         elif filename[i].startswith("Energy"):
-            time_step, diff_rel_energies, delta_rel_energies = extract_energy_from_energy_file(filename[i])
+            time_step, diff_rel_energies, delta_rel_energies = extract_energy_from_energy_file(filename[i], dtype, cache_dir)
             plot_data_from_energy(time_step, diff_rel_energies, delta_rel_energies, filename[i])
 
         elif filename[i].startswith("TandV"):
-            time_steps, pe_total, ke_total, pe_rel, ke_rel = extract_data_from_tandv_file(filename[i])
+            time_steps, pe_total, ke_total, pe_rel, ke_rel = extract_data_from_tandv_file(filename[i], dtype, cache_dir)
             plot_data_from_tandv(time_steps, pe_total, ke_total, pe_rel, ke_rel, filename[i])
 
         elif filename[i].endswith(".xyz"):
             atom1 = args.atom_pair[0]
             atom2 = args.atom_pair[1]
-            time_distances_array, atom1_type, atom2_type = read_coordinates(filename[i], atom1, atom2)
+            cell = cell_matrix(args.cell) if args.cell is not None else None
+            time_distances_array, atom1_type, atom2_type = read_coordinates(filename[i], atom1, atom2, cell, cache_dir)
             plot_data_from_xyz(time_distances_array, atom1, atom2, atom1_type, atom2_type, filename[i].strip(".xyz"))
 
         else:
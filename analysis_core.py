@@ -0,0 +1,598 @@
+import numpy as np
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat, product
+import scipy.fft
+
+
+# Frame reader, geometry kernels and cache shared by trj_analysis.py and aimdanalysis.py
+CACHE_DIR = '.trj_cache'
+CACHE_SIZE = 10e9  # bytes
+INDEX_CHUNK_SIZE = 64 << 20  # bytes
+READ_BLOCK_FRAMES = 4096
+SPEED_OF_LIGHT = 2.99792458e-5  # cm/fs
+MIN_BLOCKS = 32  # fewest blocks at which a blocking standard error is trusted
+
+
+def _parse_frame_block(lines, num_atoms):
+    # Bulk conversion of a block of fixed-size xyz frames, any incomplete trailing frame is dropped
+    frame_length = num_atoms + 2
+    num_frames = len(lines) // frame_length
+    frames = np.array(lines[:num_frames * frame_length], dtype=object).reshape(num_frames, frame_length)
+
+    coords = np.loadtxt(frames[:, 2:].ravel().tolist(), usecols=(1, 2, 3), ndmin=2)
+    coords = np.ascontiguousarray(coords.reshape(num_frames, num_atoms, 3))
+    symbols = np.array([line.split()[0] for line in frames[0, 2:]]) if num_frames else np.array([], dtype=str)
+
+    return coords, symbols
+
+
+def _find_first_frame(filename):
+    # Byte offset and atom count of the first atom-count header line
+    offset = 0
+    with open(filename, 'rb') as file:
+        for line in file:
+            if line.strip().isdigit():
+                return offset, int(line)
+            offset += len(line)
+
+    raise ValueError(f"No frames found in {filename}")
+
+
+def _scan_frame_offsets(filename, start, num_atoms):
+    # Locate every complete frame after byte offset start (a frame boundary) from vectorized newline
+    # searches, keeping only the frame boundaries so memory scales with frames, not lines
+    frame_length = num_atoms + 2
+    frame_ends = []
+    num_lines = 0
+    position = start
+
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        while True:
+            chunk = file.read(INDEX_CHUNK_SIZE)
+            if not chunk:
+                break
+            # global line number of each newline in this chunk, 0-indexed from start
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == 10)
+            line_numbers = np.arange(num_lines, num_lines + len(newlines)) % frame_length
+            line_ends = newlines + position + 1
+            frame_ends.append(line_ends[line_numbers == frame_length - 1])
+            num_lines += len(newlines)
+            position += len(chunk)
+
+    frame_ends = np.concatenate(frame_ends) if frame_ends else np.empty(0, dtype=np.int64)
+    num_frames = len(frame_ends)
+    offsets = np.concatenate(([start], frame_ends[:-1])).astype(np.int64)[:num_frames]
+    end = int(frame_ends[-1]) if num_frames else start
+
+    return offsets, end
+
+
+def index_head_hash(filename, start, end):
+    # Hash of the start of the indexed region, unaffected by frames appended later
+    with open(filename, 'rb') as file:
+        file.seek(start)
+        return hashlib.sha256(file.read(min(4096, end - start))).hexdigest()
+
+
+def index_tail_hash(filename, start, end):
+    # Hash of the last indexed bytes, also unaffected by frames appended later but not shared by a rerun
+    # that only starts from the same geometry
+    tail_start = max(start, end - 4096)
+    with open(filename, 'rb') as file:
+        file.seek(tail_start)
+        return hashlib.sha256(file.read(end - tail_start)).hexdigest()
+
+
+def index_hashes(filename, start, end):
+    return {'head': index_head_hash(filename, start, end), 'tail': index_tail_hash(filename, start, end)}
+
+
+def index_matches(filename, index):
+    # Whether the region start:end recorded in an index is unchanged, checking the bytes at both ends
+    start = int(index.get('start', 0))
+    end = int(index['end'])
+    if 'tail' not in index or end > os.path.getsize(filename):
+        return False
+
+    return index_hashes(filename, start, end) == {'head': str(index['head']), 'tail': str(index['tail'])}
+
+
+def save_index(filename, index):
+    index_path = f'{filename}.idx.npz'
+    tmp_path = f'{index_path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp_path, 'wb') as file:
+            np.savez(file, **index)
+        os.replace(tmp_path, index_path)
+    except OSError as error:
+        print(f"Unable to save frame index {index_path}: {error}")
+
+    return None
+
+
+def load_frame_index(filename):
+    # Byte offset of every complete frame, built once, saved next to the trajectory as <trj>.idx.npz
+    # and extended in place when frames are appended to the trajectory
+    index_path = f'{filename}.idx.npz'
+    size = os.path.getsize(filename)
+
+    index = None
+    if os.path.isfile(index_path):
+        with np.load(index_path) as data:
+            # per-frame step numbers saved by older versions are not used
+            index = {name: data[name] for name in data.files if name != 'steps'}
+        if not index_matches(filename, index):
+            print(f"Frame index {index_path} is out of date, rebuilding")
+            index = None
+
+    if index is None:
+        print(f"Building frame index for {filename}")
+        start, num_atoms = _find_first_frame(filename)
+        offsets, end = _scan_frame_offsets(filename, start, num_atoms)
+        index = {'offsets': offsets, 'end': end, 'start': start, 'num_atoms': num_atoms}
+        index.update(index_hashes(filename, start, end))
+        save_index(filename, index)
+
+    elif size > int(index['end']):
+        offsets, end = _scan_frame_offsets(filename, int(index['end']), int(index['num_atoms']))
+        if len(offsets):
+            index['offsets'] = np.concatenate((index['offsets'], offsets))
+            index['end'] = end
+            index.update(index_hashes(filename, int(index['start']), end))
+            save_index(filename, index)
+
+    return index
+
+
+def _read_frame_ranges(filename, starts, ends, num_atoms, atom_tuple_list=None, cell=None):
+    # Parse the frames spanning the byte ranges starts/ends in blocks, returning the coordinates, or the
+    # (n_frames, n_pairs) distances of atom_tuple_list so that only those leave the worker
+    if atom_tuple_list is None:
+        values = np.empty((len(starts), num_atoms, 3))
+    else:
+        values = np.empty((len(starts), len(atom_tuple_list)))
+    symbols = np.array([], dtype=str)
+
+    with open(filename, 'rb') as file:
+        for block_start in range(0, len(starts), READ_BLOCK_FRAMES):
+            block_starts = starts[block_start:block_start + READ_BLOCK_FRAMES]
+            block_ends = ends[block_start:block_start + READ_BLOCK_FRAMES]
+            # split into runs of consecutive frames
+            breaks = np.flatnonzero(block_starts[1:] != block_ends[:-1]) + 1
+            lines = []
+            for run_start, run_end in zip(np.split(block_starts, breaks), np.split(block_ends, breaks)):
+                file.seek(run_start[0])
+                lines.extend(file.read(run_end[-1] - run_start[0]).decode().splitlines())
+
+            block_coords, block_symbols = _parse_frame_block(lines, num_atoms)
+            if atom_tuple_list is None:
+                values[block_start:block_start + len(block_coords)] = block_coords
+            else:
+                values[block_start:block_start + len(block_coords)] = pair_distances(block_coords, atom_tuple_list, cell).T
+            if block_start == 0:
+                symbols = block_symbols
+
+    return values, symbols
+
+
+def read_indexed_frames(filename, index, frames, workers=1, atom_tuple_list=None, cell=None):
+    # Seek straight to the selected frames. With workers > 1 the frames are split into chunks at frame
+    # boundaries, parsed in a process pool and reassembled in order. If atom_tuple_list is given the
+    # (n_pairs, n_frames) distances are returned in place of the coordinates
+    num_atoms = int(index['num_atoms'])
+    frames = np.asarray(frames, dtype=np.int64)
+    starts = index['offsets'][frames]
+    ends = np.append(index['offsets'][1:], index['end'])[frames]
+
+    if workers > 1 and len(frames) > READ_BLOCK_FRAMES:
+        chunk_size = max(READ_BLOCK_FRAMES, -(-len(frames) // (4 * workers)))
+        chunk_bounds = range(0, len(frames), chunk_size)
+        print(f"Parsing {len(frames)} frames in {len(chunk_bounds)} chunks on {workers} processes")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(_read_frame_ranges,
+                                        repeat(filename),
+                                        [starts[i:i + chunk_size] for i in chunk_bounds],
+                                        [ends[i:i + chunk_size] for i in chunk_bounds],
+                                        repeat(num_atoms),
+                                        repeat(atom_tuple_list),
+                                        repeat(cell)))
+        values = np.concatenate([result[0] for result in results])
+        symbols = results[0][1]
+    else:
+        values, symbols = _read_frame_ranges(filename, starts, ends, num_atoms, atom_tuple_list, cell)
+
+    if atom_tuple_list is not None:
+        values = values.T
+
+    return values, symbols
+
+
+def read_frame_comments(filename, index, frames):
+    # Comment line of each selected frame, read without parsing the coordinates
+    comments = []
+    with open(filename, 'rb') as file:
+        for offset in index['offsets'][np.asarray(frames, dtype=np.int64)]:
+            file.seek(offset)
+            file.readline()
+            comments.append(file.readline().decode().strip())
+
+    return comments
+
+
+def select_frames(index, skip_number=0, stop_number=None, stride=1):
+    return np.arange(len(index['offsets']))[skip_number:stop_number:stride]
+
+
+def read_trj_frames(filename, skip_number=0, stop_number=None, stride=1, workers=1):
+    # Read the selected frames as a (n_frames, n_atoms, 3) array plus a single element symbol vector
+    index = load_frame_index(filename)
+    frames = select_frames(index, skip_number, stop_number, stride)
+
+    return read_indexed_frames(filename, index, frames, workers)
+
+
+def cell_matrix(cell):
+    # Lattice vectors as rows of a 3x3 matrix from a b c (orthorhombic), a b c alpha beta gamma
+    # (triclinic, degrees) or the nine components of the three lattice vectors
+    cell = np.asarray(cell, dtype=float).ravel()
+    if len(cell) == 3:
+        return np.diag(cell)
+    if len(cell) == 9:
+        return cell.reshape(3, 3)
+    if len(cell) != 6:
+        raise ValueError("Cell must be given as 3, 6 or 9 values")
+
+    a, b, c = cell[:3]
+    alpha, beta, gamma = np.radians(cell[3:])
+    cx = c * np.cos(beta)
+    cy = c * (np.cos(alpha) - np.cos(beta) * np.cos(gamma)) / np.sin(gamma)
+    cz = np.sqrt(c ** 2 - cx ** 2 - cy ** 2)
+
+    return np.array([[a, 0.0, 0.0],
+                     [b * np.cos(gamma), b * np.sin(gamma), 0.0],
+                     [cx, cy, cz]])
+
+
+def minimum_image(delta, cell):
+    # Apply the minimum image convention to displacement vectors of any leading shape, batched over all
+    # frames and pairs
+    fractional = delta @ np.linalg.inv(cell)
+    fractional -= np.round(fractional)
+    delta = fractional @ cell
+    if np.allclose(cell, np.diag(np.diag(cell))):
+        return delta
+
+    # Rounding fractional coordinates is only exact for orthorhombic cells, check the neighbouring images
+    best_squared = np.einsum('...i,...i->...', delta, delta)
+    best = delta.copy()
+    for shift in product((-1, 0, 1), repeat=3):
+        if any(shift):
+            candidate = delta + np.array(shift) @ cell
+            squared = np.einsum('...i,...i->...', candidate, candidate)
+            closer = squared < best_squared
+            best[closer] = candidate[closer]
+            best_squared[closer] = squared[closer]
+
+    return best
+
+
+def pair_distances(coords, atom_tuple_list, cell=None):
+    # switched atom numbering from 1-index to 0-index
+    index1 = np.array([pair[0] for pair in atom_tuple_list], dtype=int) - 1
+    index2 = np.array([pair[1] for pair in atom_tuple_list], dtype=int) - 1
+
+    # (n_frames, n_pairs, 3) -> (n_pairs, n_frames)
+    delta = coords[:, index1] - coords[:, index2]
+    if cell is not None:
+        delta = minimum_image(delta, cell)
+
+    return np.linalg.norm(delta, axis=-1).T
+
+
+def cache_key(filename, skip_number, stop_number, stride, block_size=1 << 20, tag=None):
+    # Key on path, size, mtime and a hash of the leading and trailing content of the trajectory. A tag keeps
+    # other kinds of cached data read from the same file apart from the trajectory entries
+    stat = os.stat(filename)
+    digest = hashlib.sha256()
+    if tag is not None:
+        digest.update(f'{tag}|'.encode())
+    digest.update(f'{os.path.abspath(filename)}|{stat.st_size}|{stat.st_mtime_ns}|'
+                  f'skip={skip_number}|stop={stop_number}|stride={stride}'.encode())
+    with open(filename, 'rb') as file:
+        digest.update(file.read(block_size))
+        if stat.st_size > 2 * block_size:
+            file.seek(stat.st_size - block_size)
+        digest.update(file.read(block_size))
+
+    return digest.hexdigest()[:24]
+
+
+def _cache_path(cache_dir, key, name):
+    return os.path.join(cache_dir, f'{key}_{name}.npy')
+
+
+def load_from_cache(cache_dir, key, name, mmap_mode='r'):
+    path = _cache_path(cache_dir, key, name)
+
+    # Refresh the modification time so that eviction removes the least recently used entries first. Another
+    # process may evict the entry at any point, which counts as a miss
+    try:
+        os.utime(path)
+        return np.load(path, mmap_mode=mmap_mode)
+    except FileNotFoundError:
+        return None
+
+
+def save_to_cache(cache_dir, key, name, array, cache_size):
+    array = np.asarray(array)
+    if array.nbytes > cache_size:
+        print(f"Not caching {name}, {array.nbytes / 1e9:.2f} GB exceeds the cache size")
+        return None
+
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _cache_path(cache_dir, key, name)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.save(file, array)
+    os.replace(tmp_path, path)
+
+    _evict_cache(cache_dir, cache_size)
+
+    return None
+
+
+def _evict_cache(cache_dir, cache_size):
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(('.npy', '.npz', '.bin')):
+            # entries may be evicted by other processes saving to the same cache
+            try:
+                stat = os.stat(os.path.join(cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    total_size = sum(entry[1] for entry in entries)
+    for mtime, size, name in sorted(entries):
+        if total_size <= cache_size:
+            break
+        print(f"Evicting {name} from cache")
+        try:
+            os.remove(os.path.join(cache_dir, name))
+        except FileNotFoundError:
+            pass
+        total_size -= size
+
+    return None
+
+
+def extract_distances(filename, atom_tuple_list, skip_number=0, stop_number=None, stride=1,
+                      cache_dir=CACHE_DIR, cache_size=CACHE_SIZE, workers=1, cell=None):
+    # Return (sim_list, distances_array, symbols), taking distances, coordinates and symbols from the
+    # cache where available and parsing the trajectory at most once for everything else
+    num_tuples = len(atom_tuple_list)
+    pair_names = [f'{pair[0]}-{pair[1]}' for pair in atom_tuple_list]
+    if cell is not None:
+        cell_tag = hashlib.sha256(np.asarray(cell, dtype=float).tobytes()).hexdigest()[:8]
+        pair_names = [f'{name}_cell{cell_tag}' for name in pair_names]
+    distances_list = [None] * num_tuples
+    symbols = None
+
+    key = cache_key(filename, skip_number, stop_number, stride) if cache_dir is not None else None
+    if key is not None:
+        symbols = load_from_cache(cache_dir, key, 'symbols')
+        for i in range(num_tuples):
+            distances_list[i] = load_from_cache(cache_dir, key, f'distances_{pair_names[i]}')
+            if distances_list[i] is not None:
+                print(f"Distances for atom pair {pair_names[i]} found in cache")
+
+    missing = [i for i in range(num_tuples) if distances_list[i] is None]
+    missing_pairs = [atom_tuple_list[i] for i in missing]
+    if symbols is None or missing:
+        coords = load_from_cache(cache_dir, key, 'coords') if key is not None and missing else None
+        index = load_frame_index(filename) if coords is None or symbols is None else None
+        if not missing:
+            # Only the element symbols are needed, take them from the first frame
+            missing_distances = []
+            symbols = read_indexed_frames(filename, index, [0])[1]
+        elif coords is not None and symbols is not None:
+            print("Coordinates found in cache")
+            missing_distances = pair_distances(coords, missing_pairs, cell)
+        else:
+            frames = select_frames(index, skip_number, stop_number, stride)
+            print("Reading trajectory...")
+            if key is not None and len(frames) * int(index['num_atoms']) * 24 <= cache_size:
+                coords, symbols = read_indexed_frames(filename, index, frames, workers=workers)
+                save_to_cache(cache_dir, key, 'coords', coords, cache_size)
+                missing_distances = pair_distances(coords, missing_pairs, cell)
+            else:
+                # Coordinates are not kept, only the distances of the requested pairs
+                missing_distances, symbols = read_indexed_frames(filename, index, frames, workers=workers,
+                                                                 atom_tuple_list=missing_pairs, cell=cell)
+        if key is not None:
+            save_to_cache(cache_dir, key, 'symbols', symbols, cache_size)
+
+        if missing:
+            print(f"Extracted distances for {len(missing)} atom pairs")
+        for i, distances in zip(missing, missing_distances):
+            distances_list[i] = distances
+            if key is not None:
+                save_to_cache(cache_dir, key, f'distances_{pair_names[i]}', distances, cache_size)
+
+    distances_array = np.array(distances_list, dtype=float).reshape(num_tuples, -1)
+    sim_list = skip_number + stride * np.arange(distances_array.shape[1])
+
+    return sim_list, distances_array, np.asarray(symbols)
+
+
+def load_coordinates(filename, skip_number=0, stop_number=None, stride=1,
+                     cache_dir=CACHE_DIR, cache_size=CACHE_SIZE, workers=1):
+    key = cache_key(filename, skip_number, stop_number, stride) if cache_dir is not None else None
+    if key is not None:
+        coords = load_from_cache(cache_dir, key, 'coords')
+        symbols = load_from_cache(cache_dir, key, 'symbols')
+        if coords is not None and symbols is not None:
+            print("Coordinates found in cache")
+            return coords, symbols
+
+    print("Reading trajectory...")
+    coords, symbols = read_trj_frames(filename, skip_number, stop_number, stride, workers=workers)
+    if key is not None:
+        save_to_cache(cache_dir, key, 'symbols', symbols, cache_size)
+        save_to_cache(cache_dir, key, 'coords', coords, cache_size)
+
+    return coords, symbols
+
+
+def autocorrelation(series):
+    # Normalised autocorrelation of every row of a (n_series, n_steps) array from one batched real FFT, zero
+    # padded so that the correlation does not wrap around. Missing values are replaced by the row mean
+    series = np.atleast_2d(np.asarray(series, dtype=float))
+    num_steps = series.shape[1]
+    centred = np.nan_to_num(series - np.nanmean(series, axis=1, keepdims=True))
+
+    size = scipy.fft.next_fast_len(2 * num_steps, real=True)
+    transform = scipy.fft.rfft(centred, n=size, axis=1, workers=-1)
+    correlation = scipy.fft.irfft(transform.real ** 2 + transform.imag ** 2, n=size, axis=1, workers=-1)[:, :num_steps]
+    # unbiased estimate, each lag averages over num_steps - lag pairs of steps
+    correlation /= num_steps - np.arange(num_steps)
+    variance = correlation[:, :1]
+
+    return np.divide(correlation, variance, out=np.zeros_like(correlation), where=variance > 0)
+
+
+def power_spectrum(series, time_step):
+    # One-sided power spectrum of every row of a (n_series, n_steps) array from one batched real FFT of the
+    # Hann-windowed series, with time_step in fs and frequencies in cm-1
+    series = np.atleast_2d(np.asarray(series, dtype=float))
+    num_steps = series.shape[1]
+    centred = np.nan_to_num(series - np.nanmean(series, axis=1, keepdims=True))
+
+    transform = scipy.fft.rfft(centred * np.hanning(num_steps), axis=1, workers=-1)
+    power = (transform.real ** 2 + transform.imag ** 2) * time_step / num_steps
+    frequencies = scipy.fft.rfftfreq(num_steps, d=time_step) / SPEED_OF_LIGHT
+
+    return frequencies, power
+
+
+def dominant_frequencies(frequencies, power):
+    # Frequency of the highest peak of each spectrum, ignoring the zero frequency bin
+    if power.shape[1] < 2:
+        return np.full(power.shape[0], np.nan)
+
+    return frequencies[1:][np.argmax(power[:, 1:], axis=1)]
+
+
+def blocking_errors(series):
+    # Flyvbjerg-Petersen blocking of every row of a (n_series, n_steps) array: the standard error of the mean
+    # estimated after each successive pairwise averaging of neighbouring values, and the uncertainty of that
+    # estimate, both (n_series, n_levels)
+    blocked = np.atleast_2d(np.asarray(series))
+    errors = []
+    uncertainties = []
+
+    while blocked.shape[1] >= 2:
+        num_blocks = blocked.shape[1]
+        error = np.sqrt(np.var(blocked, axis=1, dtype=np.float64) / (num_blocks - 1))
+        errors.append(error)
+        uncertainties.append(error / np.sqrt(2 * (num_blocks - 1)))
+        even = num_blocks - num_blocks % 2
+        blocked = 0.5 * (blocked[:, 0:even:2] + blocked[:, 1:even:2])
+
+    if not errors:
+        return np.full((len(blocked), 1), np.nan), np.full((len(blocked), 1), np.nan)
+
+    return np.array(errors).T, np.array(uncertainties).T
+
+
+def _plateau_errors(errors, uncertainties, num_steps, min_blocks=MIN_BLOCKS):
+    # Standard error at the plateau of each blocking curve: the first level whose estimate agrees within the
+    # uncertainties with every later level, only considering levels with at least min_blocks blocks
+    num_levels = max(1, min(errors.shape[1], int(np.log2(max(num_steps / min_blocks, 1))) + 1))
+    errors = errors[:, :num_levels]
+    uncertainties = uncertainties[:, :num_levels]
+
+    # lower bound of the largest estimate of all later levels, -inf for the last level
+    lower = errors - uncertainties
+    later_max = np.full_like(errors, -np.inf)
+    later_max[:, :-1] = np.maximum.accumulate(lower[:, ::-1], axis=1)[:, ::-1][:, 1:]
+    plateau = np.argmax(errors + uncertainties >= later_max, axis=1)
+
+    return errors[np.arange(len(errors)), plateau]
+
+
+def block_average(series, min_blocks=MIN_BLOCKS):
+    # Standard error of the mean of every row of a (n_series, n_steps) array at the plateau of its blocking curve
+    errors, uncertainties = blocking_errors(series)
+
+    return _plateau_errors(errors, uncertainties, np.atleast_2d(series).shape[1], min_blocks)
+
+
+def init_blocking(num_series):
+    # Online blocking of num_series series: count, sum and sum of squares of the values at each blocking level,
+    # and the one value per level still waiting for its neighbour. Values are shifted by the first value of each
+    # series to keep the sums well conditioned
+    return {'count': [], 'sum': [], 'sum_squares': [], 'pending': [], 'shift': None, 'num_series': num_series}
+
+
+def update_blocking(state, values):
+    # Fold (n_series, n_new) values into the blocking state in place, pairing neighbouring values level by level
+    # in the same order as blocking_errors, so memory is O(log n) per series
+    values = np.asarray(values, dtype=np.float64)
+    if values.shape[1] == 0:
+        return state
+    if state['shift'] is None:
+        state['shift'] = values[:, 0].copy()
+    values = values - state['shift'][:, None]
+
+    level = 0
+    while values.shape[1]:
+        if level == len(state['count']):
+            state['count'].append(0)
+            state['sum'].append(np.zeros(state['num_series']))
+            state['sum_squares'].append(np.zeros(state['num_series']))
+            state['pending'].append(None)
+        state['count'][level] += values.shape[1]
+        state['sum'][level] += values.sum(axis=1)
+        state['sum_squares'][level] += (values ** 2).sum(axis=1)
+
+        if state['pending'][level] is not None:
+            values = np.concatenate((state['pending'][level][:, None], values), axis=1)
+        even = values.shape[1] - values.shape[1] % 2
+        state['pending'][level] = values[:, -1].copy() if even < values.shape[1] else None
+        values = 0.5 * (values[:, 0:even:2] + values[:, 1:even:2])
+        level += 1
+
+    return state
+
+
+def online_blocking_errors(state):
+    # Same (n_series, n_levels) standard errors and uncertainties as blocking_errors, from the blocking state
+    levels = [level for level, count in enumerate(state['count']) if count >= 2]
+    if not levels:
+        return np.full((state['num_series'], 1), np.nan), np.full((state['num_series'], 1), np.nan)
+
+    counts = np.array([state['count'][level] for level in levels], dtype=np.float64)
+    means = np.array([state['sum'][level] for level in levels]).T / counts
+    variances = np.maximum(np.array([state['sum_squares'][level] for level in levels]).T / counts - means ** 2, 0)
+    errors = np.sqrt(variances / (counts - 1))
+
+    return errors, errors / np.sqrt(2 * (counts - 1))
+
+
+def online_block_average(state, min_blocks=MIN_BLOCKS):
+    # Plateau standard error of the mean of every series folded into the blocking state
+    errors, uncertainties = online_blocking_errors(state)
+    num_steps = state['count'][0] if state['count'] else 0
+
+    return _plateau_errors(errors, uncertainties, num_steps, min_blocks)
+
+
+def statistical_inefficiency(standard_errors, variances, num_samples):
+    # Number of correlated samples per independent sample, g = n * SE^2 / variance
+    variances = np.asarray(variances, dtype=float)
+    return np.divide(num_samples * np.asarray(standard_errors) ** 2, variances,
+                     out=np.full(variances.shape, np.nan), where=variances > 0)
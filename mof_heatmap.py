@@ -2,6 +2,55 @@ import matplotlib.pyplot as plt
 from matplotlib.colors import LinearSegmentedColormap
 import matplotlib.gridspec as gridspec
 import numpy as np
+import csv
+import os
+import sys
+
+# Green for 0, Red for 1
+colors = [(0, 0.5, 0, 0.7), (1, 1, 0, 0.7), (1, 0, 0, 0.7)]  # RGB for Dark Forest Green, Yellow, Red
+cmap_name = 'green_yellow_red'
+cm = LinearSegmentedColormap.from_list(cmap_name, colors, N=100)
+
+
+# Load an occupancy matrix written by trj_analysis.py, rows are atom pairs and columns are windows
+def load_occupancy_matrix(filename):
+    with open(filename, 'r', newline='') as file:
+        rows = list(csv.reader(file))
+
+    column_labels = rows[0][1:]
+    row_labels = [row[0] for row in rows[1:]]
+    matrix = np.array([row[1:] for row in rows[1:]], dtype=float).reshape(len(row_labels), len(column_labels))
+
+    return matrix, row_labels, column_labels
+
+
+def plot_occupancy_heatmap(filename):
+    matrix, row_labels, column_labels = load_occupancy_matrix(filename)
+
+    fig, ax = plt.subplots(figsize=(1.5 * len(column_labels) + 2, 0.5 * len(row_labels) + 2))
+    ax.matshow(matrix, cmap=cm, vmin=0, vmax=1)
+
+    # Label each cell with its value
+    for i in range(matrix.shape[0]):
+        for j in range(matrix.shape[1]):
+            ax.text(j, i, f"{matrix[i, j]:.2f}", va='center', ha='center', color='black', fontweight='bold')
+
+    ax.set_xticks(range(len(column_labels)))
+    ax.set_yticks(range(len(row_labels)))
+    ax.set_xticklabels([label.replace('_', ' ') for label in column_labels])
+    ax.set_yticklabels(row_labels, fontweight='bold')
+
+    plt.tight_layout()
+    plt.savefig(f"{os.path.splitext(filename)[0]}_heatmap.pdf")
+    plt.close(fig)
+
+
+# Plot occupancy matrices given on the command line instead of the hand-typed summaries below
+if len(sys.argv) > 1:
+    for occupancy_file in sys.argv[1:]:
+        print(f'Plotting occupancy heatmap for {occupancy_file}')
+        plot_occupancy_heatmap(occupancy_file)
+    sys.exit(0)
 
 # Plot 1 for dobpdc
 print('Plotting coarse summary (plot 1)')
@@ -10,11 +59,6 @@ matrix = np.array([[0.00, 0.55, 0.40],
                    [0.00, 0.42, 0.00],
                    [0.00, 0.55, 0.36]])
 
-# Green for 0, Red for 1
-colors = [(0, 0.5, 0, 0.7), (1, 1, 0, 0.7), (1, 0, 0, 0.7)]  # RGB for Dark Forest Green, Yellow, Red
-cmap_name = 'green_yellow_red'
-cm = LinearSegmentedColormap.from_list(cmap_name, colors, N=100)
-
 # Creating the heat map
 fig, ax = plt.subplots(figsize=(6, 4))
 cax = ax.matshow(matrix, cmap=cm)
@@ -1,6 +1,10 @@
 import os
-import shutil
 import sys
+import argparse
+import csv
+import json
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 """
 Script to generate CAS-CI scan for orbital contraction project
@@ -8,61 +12,132 @@ First argument is template script to be modified
 Second argument is first scan distance
 Third argument is last scan distance
 Fourth argument is number of scan steps
+Distances can instead be listed with --distances, or spaced geometrically with --spacing geometric
 """
 
-if len(sys.argv) < 5:
-    print("Args: [template] [first distance] [last distance] [scan steps]")
-    exit(0)
-
-# Get the current working directory as the source directory
-source_directory = os.getcwd()
-
-# Get the current working directory as the base directory
-base_directory = os.getcwd()
-
-# Get the script name from the command-line argument
-script_name = sys.argv[1]
-print(f"Template: {script_name}")
-
-# Get the range of distances and number of steps to scan over
-
-first_dist = float(sys.argv[2])
-print(f"First distance: {first_dist}")
-last_dist = float(sys.argv[3])
-print(f"Last distance: {last_dist}")
-scan_steps = int(sys.argv[4])
-print(f"Scan steps: {scan_steps}")
-
-print("=========================")
-
-scan_range = float(last_dist) - float(first_dist)
-interval = round((scan_range / scan_steps), 5)
-scan_list = []
-
-# Create directories and copy the script into each directory
-for i in range(scan_steps+1):
-
-    # Generate list of distances to scan over
-    scan_list.append(first_dist + (i*interval))
-
-    # Create the new directory
-    subdir_name = str(round(scan_list[i], 2))
-    new_directory = os.path.join(base_directory, subdir_name)
-    os.makedirs(new_directory, exist_ok=True)
-
-    # Copy the script into the new directory
-    script_destination = os.path.join(new_directory, script_name)
-    shutil.copy(os.path.join(source_directory, script_name), script_destination)
-
-    # Replace the "SCAN_DISTANCE" string with the scan length
-    with open(script_destination, "r") as file:
-        script_content = file.read()
-        modified_content = script_content.replace("SCAN_DISTANCE", str(scan_list[i]))
-
-    with open(script_destination, "w") as file:
-        file.write(modified_content)
-
-    print(f"Created scan length {subdir_name}")
-
-print("=========================")
-print("Finished creating jobs")
+PLACEHOLDER = "SCAN_DISTANCE"
+MAX_NAME_DECIMALS = 10  # decimals allowed in directory names before close distances are treated as duplicates
+
+
+def get_args():
+    my_parser = argparse.ArgumentParser(usage="%(prog)s template [first distance] [last distance] [scan steps]")
+    my_parser.add_argument("template",
+                           help="Input template in which every SCAN_DISTANCE is replaced by the scan distance")
+    my_parser.add_argument("first_dist",
+                           nargs='?',
+                           type=float,
+                           help="First scan distance")
+    my_parser.add_argument("last_dist",
+                           nargs='?',
+                           type=float,
+                           help="Last scan distance")
+    my_parser.add_argument("scan_steps",
+                           nargs='?',
+                           type=int,
+                           help="Number of scan steps, giving scan_steps + 1 distances")
+    my_parser.add_argument("--spacing",
+                           choices=("linear", "geometric"),
+                           default="linear",
+                           help="Space the distances evenly (linspace) or by a constant ratio (geomspace)")
+    my_parser.add_argument("-d", "--distances",
+                           nargs='+',
+                           type=float,
+                           help="Explicit list of scan distances, instead of first, last and steps")
+    my_parser.add_argument("-m", "--manifest",
+                           default="multicas_manifest.csv",
+                           help="File mapping each directory to its distance, JSON if it ends in .json, otherwise csv")
+    my_parser.add_argument("-j", "--workers",
+                           type=int,
+                           default=None,
+                           help="Number of threads writing the inputs")
+    args = my_parser.parse_args()
+
+    if args.distances is None and args.scan_steps is None:
+        my_parser.print_usage()
+        sys.exit(0)
+    return args
+
+
+def scan_distances(first_dist, last_dist, scan_steps, spacing="linear"):
+    if spacing == "geometric":
+        return np.geomspace(first_dist, last_dist, scan_steps + 1)
+    return np.linspace(first_dist, last_dist, scan_steps + 1)
+
+
+def directory_names(distances):
+    # Shortest rounding (at least 2 decimals, as before) that gives every distance its own directory
+    for decimals in range(2, MAX_NAME_DECIMALS + 1):
+        names = [str(round(float(distance), decimals)) for distance in distances]
+        if len(set(names)) == len(names):
+            return names
+    raise ValueError("Scan distances are not unique")
+
+
+def write_input(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        file.write(content)
+
+
+def write_manifest(manifest_path, names, distances):
+    print(f"Writing manifest to {manifest_path}")
+    if manifest_path.endswith(".json"):
+        with open(manifest_path, "w") as file:
+            json.dump([{"directory": name, "distance": float(distance)} for name, distance in zip(names, distances)],
+                      file, indent=2)
+        return
+
+    with open(manifest_path, "w", newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(["Directory", "Distance"])
+        writer.writerows(zip(names, (float(distance) for distance in distances)))
+
+
+def generate_scan(template, distances, base_directory, manifest_path=None, workers=None):
+    # Render the template once per distance in memory and write every input from a thread pool
+    with open(template, "r") as file:
+        template_parts = file.read().split(PLACEHOLDER)
+    if len(template_parts) == 1:
+        print(f"Warning: {template} does not contain {PLACEHOLDER}")
+
+    names = directory_names(distances)
+    script_name = os.path.basename(template)
+    paths = [os.path.join(base_directory, name, script_name) for name in names]
+    # distances keep their decimal point, so a template reading them as floats still gets 1.0 rather than 1
+    contents = [np.format_float_positional(float(distance), precision=10, trim='0').join(template_parts)
+                for distance in distances]
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(write_input, paths, contents))
+
+    for name in names:
+        print(f"Created scan length {name}")
+    if manifest_path is not None:
+        write_manifest(os.path.join(base_directory, manifest_path), names, distances)
+
+    return names
+
+
+if __name__ == '__main__':
+
+    args = get_args()
+
+    # Get the current working directory as the base directory
+    base_directory = os.getcwd()
+    print(f"Template: {args.template}")
+
+    if args.distances is not None:
+        distances = np.array(args.distances)
+        print(f"Distances: {', '.join(f'{distance:g}' for distance in distances)}")
+    else:
+        print(f"First distance: {args.first_dist}")
+        print(f"Last distance: {args.last_dist}")
+        print(f"Scan steps: {args.scan_steps}")
+        distances = scan_distances(args.first_dist, args.last_dist, args.scan_steps, args.spacing)
+
+    print("=========================")
+
+    generate_scan(args.template, distances, base_directory, args.manifest, args.workers)
+
+    print("=========================")
+    print("Finished creating jobs")
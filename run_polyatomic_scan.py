@@ -1,56 +1,41 @@
 import os
-import fileinput
-import sys
-import shutil
-
-def make_subdirectories(template_path):
-    first_dist = float(sys.argv[2])
-    print(f"First distance: {first_dist}")
-    last_dist = float(sys.argv[3])
-    print(f"Last distance: {last_dist}")
-    scan_steps = int(sys.argv[4])
-    print(f"Scan steps: {scan_steps}")
-
-    scan_range = float(last_dist) - float(first_dist)
-    interval = round((scan_range / scan_steps), 5)
-    scan_list = []
-
-    # Create directories and copy the script into each directory
-    for i in range(scan_steps+1):
-
-        # Generate list of distances to scan over
-        scan_list.append(first_dist + (i*interval))
-
-        # Create the new directory
-        base_directory = os.getcwd()
-        subdir_name = str(round(scan_list[i], 2))
-        new_directory = os.path.join(base_directory, subdir_name)
-        os.makedirs(new_directory, exist_ok=True)
-
-        # Copy the input script and xyz file into the new directory
-        input_destination = os.path.join(new_directory, template_path)
-        shutil.copy(os.path.join(base_directory, template_path), input_destination)
-        xyz_destination = os.path.join(new_directory, 'scan.xyz')
-        shutil.copy(os.path.join(base_directory, 'scan.xyz'), xyz_destination)
-
-
-# def copy_template_to_subdirectories(template_path):
-    # for root, _, _ in os.walk('.'):
-    #     subdirectory = os.path.join(root, 'scan.xyz')
-    #     if os.path.isfile(subdirectory):
-    #         target_file = os.path.join(root, os.path.basename(template_path))
-    #         if not os.path.exists(target_file):
-    #             shutil.copy(template_path, target_file)
-    #             print("Copied template to ", root)
-            # else:
-            #     shutil.copy(template_path, target_file)
-            #     print("Overwritten template in ", root)
-
-    # Copy the input script and xyz file into the new directory
-    # input_destination = os.path.join(new_directory, template_path)
-    # shutil.copy(os.path.join(source_directory, template_path), input_destination)
-    # xyz_destination = os.path.join(new_directory, 'scan.xyz')
-    # shutil.copy(os.path.join(source_directory, 'scan.xyz'), xyz_destination)
+import argparse
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from run_multicas import scan_distances, directory_names, write_manifest, write_input
+
+
+def get_args():
+    my_parser = argparse.ArgumentParser()
+    my_parser.add_argument("template",
+                           help="Input template whose COORDS1 and COORDS2 lines are replaced by coordinates")
+    my_parser.add_argument("first_dist",
+                           type=float,
+                           help="First scan displacement")
+    my_parser.add_argument("last_dist",
+                           type=float,
+                           help="Last scan displacement")
+    my_parser.add_argument("scan_steps",
+                           type=int,
+                           help="Number of scan steps, giving scan_steps + 1 displacements")
+    my_parser.add_argument("first_frag_size",
+                           type=int,
+                           help="Number of atoms, at the end of the xyz file, in the fragment that is displaced")
+    my_parser.add_argument("long_dist",
+                           type=float,
+                           help="Displacement of the fragment in the COORDS1 (separated reference) geometry")
+    my_parser.add_argument("--xyz",
+                           default="scan.xyz",
+                           help="Geometry aligned along the z axis")
+    my_parser.add_argument("-m", "--manifest",
+                           default="polyatomic_manifest.csv",
+                           help="File mapping each directory to its displacement, JSON if it ends in .json")
+    my_parser.add_argument("-j", "--workers",
+                           type=int,
+                           default=None,
+                           help="Number of threads writing the inputs")
+    return my_parser.parse_args()
+
 
 def read_coordinates(file_path):
     with open(file_path, 'r') as file:
@@ -60,57 +45,68 @@ def read_coordinates(file_path):
     lines = lines[2:]
 
     # Extract the coordinates
-    coordinates = [line.strip().split() for line in lines]
+    coordinates = [line.strip().split() for line in lines if line.strip()]
 
     return coordinates
 
-def update_scan_file(input_file_path, coordinates, first_frag_size, long_dist):
-    scan_step = float(input_file_path.split('/')[1])
-    with fileinput.FileInput(input_file_path, inplace=True) as file:
-        for line in file:
+
+def _coordinate_lines(coordinates, first_frag_size, z_values):
+    # xyz lines with the z coordinates of the last first_frag_size atoms replaced by z_values
+    fixed = ["\t".join(coords) for coords in coordinates[:-first_frag_size]]
+    moved = ["\t".join((coords[0], str(float(coords[1])), str(float(coords[2])), str(float(z))))
+             for coords, z in zip(coordinates[-first_frag_size:], z_values)]
+
+    return fixed + moved
+
+
+def render_inputs(template_lines, coordinates, first_frag_size, distances, long_dist):
+    # Every scan input as text: COORDS1 lines become the fragment displaced by long_dist and COORDS2 lines the
+    # fragment displaced by each scan distance, all z coordinates computed in one array operation
+    frag_z = np.array([float(coords[3]) for coords in coordinates[-first_frag_size:]])
+    scan_z = np.round(frag_z + np.asarray(distances)[:, None], 5)
+    coords1 = _coordinate_lines(coordinates, first_frag_size, np.round(frag_z + long_dist, 5))
+
+    contents = []
+    for z_values in scan_z:
+        coords2 = _coordinate_lines(coordinates, first_frag_size, z_values)
+        lines = []
+        for line in template_lines:
             if "COORDS2" in line:
-                # for coords in coordinates:
-                #     print("\t".join(coords))
-                for i, coords in enumerate(coordinates[:-first_frag_size]):
-                    print("\t".join(coords))
-                for i, coords in enumerate(coordinates[-first_frag_size:]):
-                    updated_coords = [str(coords[0]), float(coords[1]), float(coords[2]), round(float(coords[3]) + scan_step, 5)]
-                    print("\t".join(str(x) for x in updated_coords))
+                lines += coords2
             elif "COORDS1" in line:
-                for i, coords in enumerate(coordinates[:-first_frag_size]):
-                    print("\t".join(coords))
-                for i, coords in enumerate(coordinates[-first_frag_size:]):
-                    updated_coords = [str(coords[0]), float(coords[1]), float(coords[2]), round(float(coords[3]) + long_dist, 5)]
-                    print("\t".join(str(x) for x in updated_coords))
+                lines += coords1
             else:
-                print(line.strip())
+                lines.append(line.strip())
+        contents.append("\n".join(lines) + "\n")
+
+    return contents
+
 
 if __name__ == "__main__":
 
     print("Frozen scan of molecule aligned along z axis")
 
-    if len(sys.argv) < 7:
-        print("Args: [inp name] [scan start] [scan end] [scan steps] [frag 1 size] [long dist]")
-        exit(0)
-
-    # Step 1: Copy template to all subdirectories
-    template_path = sys.argv[1]
-    print(f"Template: {template_path}")
-    make_subdirectories(template_path)
-    first_frag_size = int(sys.argv[5])
-    long_dist = float(sys.argv[6])
+    args = get_args()
+    base_directory = os.getcwd()
+    print(f"Template: {args.template}")
+    print(f"First distance: {args.first_dist}")
+    print(f"Last distance: {args.last_dist}")
+    print(f"Scan steps: {args.scan_steps}")
 
     print("=========================")
 
-    # Step 2: Read coordinates from scan.xyz and replace "COORDS1" and "COORDS2" in template
-    for root, _, files in os.walk('.'):
-        if root == '.':
-            continue
-        if 'scan.xyz' in files:
-            xyz_file_path = os.path.join(root, 'scan.xyz')
-            coordinates = read_coordinates(xyz_file_path)
-            input_file_path = os.path.join(root, template_path)
-            update_scan_file(input_file_path, coordinates, first_frag_size, long_dist)
-            print("Written coordinates to input file: ", input_file_path)
-        else:
-            print("skipping", root)
+    # Read the template and geometry once, then render and write every input in a single pass
+    with open(args.template, 'r') as file:
+        template_lines = file.readlines()
+    coordinates = read_coordinates(args.xyz)
+    distances = scan_distances(args.first_dist, args.last_dist, args.scan_steps)
+    names = directory_names(distances)
+    contents = render_inputs(template_lines, coordinates, args.first_frag_size, distances, args.long_dist)
+
+    paths = [os.path.join(base_directory, name, os.path.basename(args.template)) for name in names]
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        list(executor.map(write_input, paths, contents))
+    for path in paths:
+        print("Written coordinates to input file: ", path)
+
+    write_manifest(os.path.join(base_directory, args.manifest), names, distances)
@@ -0,0 +1,63 @@
+import importlib.util
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "2d_scan.py")
+spec = importlib.util.spec_from_file_location("scan_2d", SCRIPT)
+scan_2d = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(scan_2d)
+
+
+def _write_3d_scan(path):
+    # Energies in Ha on a 4 x 5 x 3 grid, rows shuffled and one scan point missing
+    axes = [np.linspace(1.0, 1.6, 4), np.linspace(2.0, 3.0, 5), np.linspace(0.0, 1.0, 3)]
+    points = scan_2d.scan_points(axes)
+    energies = -100 + ((points[:, 0] - 1.2) ** 2 + (points[:, 1] - 2.5) ** 2 + 2 * points[:, 2]) / 627.509
+    rows = np.column_stack((points, energies))[np.random.default_rng(0).permutation(len(points))][:-1]
+    np.savetxt(path, rows, delimiter=',', header='r1,r2,angle,E', comments='')
+
+    return rows
+
+
+def test_clean_data_keeps_every_coordinate(tmp_path):
+    path = str(tmp_path / "scan.csv")
+    rows = _write_3d_scan(path)
+
+    points, energies, names = scan_2d.load_scan(path, 3, [0, 1, 2])
+    clean_points, clean_z = scan_2d._clean_data(points, energies)
+    assert names == ['r1', 'r2', 'angle']
+    np.testing.assert_allclose(clean_points, rows[:, :3])
+    np.testing.assert_allclose(clean_z, (rows[:, 3] - rows[:, 3].min()) * 627.509)
+
+    interpolant = scan_2d.fit_interpolant(clean_points, clean_z, "rbf")
+    np.testing.assert_allclose(scan_2d.evaluate_interpolant(interpolant, *clean_points[:5].T), clean_z[:5], atol=1e-6)
+
+
+def test_cli_projects_and_slices_3d_scan(tmp_path):
+    _write_3d_scan(str(tmp_path / "scan.csv"))
+    env = dict(os.environ, MPLBACKEND="Agg")
+
+    for options, name in ((["--project"], "projected"), (["--fix", "2", "0.5"], "sliced")):
+        subprocess.run([sys.executable, SCRIPT, "scan.csv", "-c", "3", "--xy_columns", "0", "1", "2", "-s",
+                        "-n", name] + options, cwd=tmp_path, env=env, check=True, capture_output=True)
+        assert (tmp_path / f"{name}.pdf").is_file()
+
+
+def test_batch_leaves_out_grid_coordinates(tmp_path):
+    # Energies in grid order of DEFAULT_SCAN, with the coordinates written alongside under their own names
+    path = str(tmp_path / "grid.csv")
+    points = scan_2d._grid_scan(np.zeros((0, 1)))[0]
+    energies = np.column_stack((-100 + points.sum(axis=1) / 627.509, -100 + points[:, 0] / 627.509))
+    np.savetxt(path, np.column_stack((points, energies)), delimiter=',', header='r_a,r_b,E1,E2', comments='')
+
+    batch = scan_2d.load_scan_columns(path)
+    assert batch[3] == [2, 3]
+    np.testing.assert_allclose(batch[1], energies)
+
+    result = subprocess.run([sys.executable, SCRIPT, "grid.csv", "--difference", "2", "3"], cwd=tmp_path,
+                            capture_output=True, text=True)
+    assert result.returncode == 2
+    assert "--difference requires --batch" in result.stderr
@@ -0,0 +1,57 @@
+import numpy as np
+
+import aimdanalysis
+
+
+def _qchem_step(step, energy):
+    return (f" TIME STEP #{step}   (t = {20.67 * step:.3f} a.u. = {0.5 * step:.5f} fs)\n"
+            f" Total energy in the final basis set = {energy:.10f}\n"
+            f" Instantaneous Temperature = {300 + step:.3f} K\n"
+            f" Time for this dynamics step: 1.5 s\n")
+
+
+def _write_output(path, text):
+    with open(path, 'w') as file:
+        file.write("Q-Chem header\n" + text)
+
+
+def test_truncated_energy_line_is_left_out_until_complete(tmp_path):
+    path = str(tmp_path / "aimd.out")
+    complete = "".join(_qchem_step(step, -150.1 - 0.001 * step) for step in range(3))
+    unfinished = _qchem_step(3, -150.1035)
+    _write_output(path, complete + unfinished[:unfinished.index("= -15") + 5])
+
+    data = aimdanalysis.parse_qchem_aimd(path)
+    np.testing.assert_allclose(data['energy'], [-150.1, -150.101, -150.102])
+
+    # the rest of the section arrives, parsing resumes from the last complete section
+    _write_output(path, complete + unfinished)
+    data = aimdanalysis.parse_qchem_aimd(path)
+    np.testing.assert_allclose(data['energy'], [-150.1, -150.101, -150.102, -150.1035])
+    np.testing.assert_allclose(data['time'], [0, 0.5, 1, 1.5])
+
+
+def test_truncated_time_step_header_does_not_raise(tmp_path):
+    path = str(tmp_path / "aimd.out")
+    complete = "".join(_qchem_step(step, -150.1) for step in range(2))
+    _write_output(path, complete + " TIME STEP #2   (t = 41")
+
+    data = aimdanalysis.parse_qchem_aimd(path)
+    assert len(data['energy']) == 2
+    assert aimdanalysis.read_qchem_steps(path, 1) == _qchem_step(1, -150.1)
+
+
+def test_float32_tables_keep_total_energies_in_float64(tmp_path):
+    path = str(tmp_path / "TandV")
+    time_steps = np.arange(50) * 0.5
+    table = np.column_stack((time_steps, -1234.567891234 + 1e-6 * np.sin(time_steps), np.full(50, 0.05),
+                             1e-4 * np.sin(time_steps), 1e-4 * np.cos(time_steps)))
+    np.savetxt(path, table, header="t pe ke pe_rel ke_rel", comments='')
+    cache_dir = str(tmp_path / "cache")
+
+    # the second read comes from the cache, which must not be shared with trajectory entries of the same file
+    for _ in range(2):
+        _, pe_total, _, pe_rel, _ = aimdanalysis.extract_data_from_tandv_file(path, np.float32, cache_dir)
+        assert pe_total.dtype == np.float64 and pe_rel.dtype == np.float32
+        np.testing.assert_array_equal(pe_total, table[:, 1])
+    assert aimdanalysis.cache_key(path, 0, None, 1, tag='table') != aimdanalysis.cache_key(path, 0, None, 1)
@@ -1,10 +1,36 @@
 import argparse
 import matplotlib.pyplot as plt
 import numpy as np
+from scipy.spatial import cKDTree
+from scipy.ndimage import gaussian_filter1d
 import ast
 import csv
+import json
 import os
-import pickle
+import time
+import hashlib
+from itertools import product
+from analysis_core import CACHE_DIR, CACHE_SIZE, READ_BLOCK_FRAMES
+from analysis_core import load_frame_index, index_matches, read_indexed_frames, select_frames
+from analysis_core import cell_matrix, minimum_image, extract_distances
+from analysis_core import autocorrelation, power_spectrum, dominant_frequencies
+from analysis_core import block_average, statistical_inefficiency, init_blocking, update_blocking, online_block_average
+
+
+DISCOVERY_FLUSH_FRAMES = 1000
+HIST_RANGE = (0.0, 20.0)  # A
+HIST_BIN_WIDTH = 0.001  # A
+MAX_TRACE_POINTS = 100000
+STREAM_BLOCK_FRAMES = 16  # frames per block mean kept by the accumulators for the blocking analysis
+
+# Reactive C–C distance ranges / A
+HAT_WINDOWS = {
+    'shuffle': (3.80, 3.86),  # alkyl radical HAT C–C distance range (2.70-2.76) + C–H bond length (1.1 A) to correct for C–H/C–H clash in MD simulations
+    'alkoxy': (3.45, 3.52),  # alkoxy radical HAT C–C distance range
+    'peroxy': (3.78, 4.33),  # peroxy radical HAT C–C distance range
+    'peroxy_decomposition': (5.068, 5.109),  # bimolecular peroxy decomposition C–C distance range
+}
+WINDOW_COLORS = {'shuffle': 'red', 'alkoxy': 'blue', 'peroxy': 'green', 'peroxy_decomposition': 'purple'}
 
 
 def parse_tuple_list(value):
@@ -29,8 +55,18 @@ def get_args():
     parser.add_argument('--atom_pair',
                         '-a',
                         type=parse_tuple_list,
-                        required=True,
                         help='atom pairs, input as list of tuples, 1-indexed')
+    parser.add_argument('--discover',
+                        nargs=2,
+                        metavar=('ELEMENT1', 'ELEMENT2'),
+                        help='Find the element pairs that spend the most time in the HAT windows and analyse those')
+    parser.add_argument('--cutoff',
+                        type=float,
+                        help='Neighbour search cutoff in A for --discover, defaults to the upper edge of the widest window')
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        help='Number of discovered atom pairs to analyse')
     parser.add_argument('--time_step',
                         '-t',
                         type=float,
@@ -39,6 +75,61 @@ def get_args():
                         type=int,
                         default=0,
                         help='Skip analysis of first n geometries in the trj file')
+    parser.add_argument('--stop',
+                        type=int,
+                        default=None,
+                        help='Stop analysis before geometry n of the trj file')
+    parser.add_argument('--stride',
+                        type=int,
+                        default=1,
+                        help='Analyse every nth geometry in the trj file')
+    parser.add_argument('--windows',
+                        type=str,
+                        help='JSON file of named distance windows in A, e.g. {"alkoxy": [3.45, 3.52]}, '
+                             'defaults to the HAT windows')
+    parser.add_argument('--cell',
+                        nargs='+',
+                        type=float,
+                        help='Periodic cell as a b c, a b c alpha beta gamma or the 9 lattice vector components, in A')
+    parser.add_argument('--workers',
+                        '-w',
+                        type=int,
+                        default=1,
+                        help='Number of processes used to parse the trajectory')
+    parser.add_argument('--cache_dir',
+                        type=str,
+                        default=CACHE_DIR,
+                        help='Directory for cached coordinates and distances')
+    parser.add_argument('--cache_size',
+                        type=float,
+                        default=CACHE_SIZE / 1e9,
+                        help='Maximum size of the cache directory in GB, least recently used entries are evicted')
+    parser.add_argument('--no_cache',
+                        action='store_true',
+                        help='Do not read from or write to the cache')
+    parser.add_argument('--streaming',
+                        action='store_true',
+                        help='Analyse the trajectory in chunks in bounded memory, using histograms for the violin plots')
+    parser.add_argument('--hist_range',
+                        nargs=2,
+                        type=float,
+                        default=HIST_RANGE,
+                        help='Distance range in A of the --streaming histograms')
+    parser.add_argument('--bin_width',
+                        type=float,
+                        default=HIST_BIN_WIDTH,
+                        help='Bin width in A of the --streaming histograms')
+    parser.add_argument('--follow',
+                        '-f',
+                        action='store_true',
+                        help='Keep polling a running trajectory and analyse frames as they are appended')
+    parser.add_argument('--poll_interval',
+                        type=float,
+                        default=60,
+                        help='Seconds between polls of the trajectory in --follow mode')
+    parser.add_argument('--spectra',
+                        action='store_true',
+                        help='Write the autocorrelation function and power spectrum of every distance series')
     parser.add_argument('--show_plots',
                         '-s',
                         type=bool,
@@ -47,130 +138,452 @@ def get_args():
 
     return parser.parse_args()
 
+def _get_atom_pair_string(symbols, atom_number1, atom_number2):
+    atom_label1 = str(symbols[atom_number1 - 1])
+    atom_label2 = str(symbols[atom_number2 - 1])
+
+    return str(atom_label1 + str(atom_number1) + '-' + atom_label2 + str(atom_number2))
+
+def _neighbour_pairs(frame_coords, cutoff, cell=None):
+    # All atom pairs (i < j) within cutoff of each other in a single frame
+    if cell is None:
+        pairs = cKDTree(frame_coords).query_pairs(cutoff, output_type='ndarray')
+        return pairs[:, 0], pairs[:, 1]
+
+    num_atoms = len(frame_coords)
+    if np.allclose(cell, np.diag(np.diag(cell))):
+        box = np.diag(cell)
+        wrapped = np.mod(frame_coords, box)
+        wrapped[wrapped >= box] = 0.0
+        pairs = cKDTree(wrapped, boxsize=box).query_pairs(cutoff, output_type='ndarray')
+        return pairs[:, 0], pairs[:, 1]
+
+    # Triclinic cells: pad the wrapped cell with the periodic images of atoms within cutoff of each face
+    inverse = np.linalg.inv(cell)
+    fractional = np.mod(frame_coords @ inverse, 1.0)
+    pad = cutoff * np.linalg.norm(inverse, axis=0)
+    images = [fractional]
+    owners = [np.arange(num_atoms)]
+    for shift in product((-1, 0, 1), repeat=3):
+        if any(shift):
+            shifted = fractional + np.array(shift)
+            keep = np.all((shifted >= -pad) & (shifted < 1 + pad), axis=1)
+            images.append(shifted[keep])
+            owners.append(np.flatnonzero(keep))
+    owner = np.concatenate(owners)
+
+    pairs = cKDTree(np.concatenate(images) @ cell).query_pairs(cutoff, output_type='ndarray')
+    pairs = pairs[(pairs[:, 0] < num_atoms) | (pairs[:, 1] < num_atoms)]
+    first, second = owner[pairs[:, 0]], owner[pairs[:, 1]]
+    distinct = first != second
+    keys = np.unique(np.minimum(first, second)[distinct] * num_atoms + np.maximum(first, second)[distinct])
+
+    return keys // num_atoms, keys % num_atoms
+
+
+def _count_window_pairs(coords, is_element1, is_element2, bounds, cutoff, cell, counts, min_distances):
+    # Add the frames each element1-element2 pair of a (n_frames, n_atoms, 3) chunk spends inside each window
+    # to counts, and lower min_distances to the closest approach of each pair within the cutoff
+    num_frames, num_atoms = coords.shape[:2]
+    pending = [[] for _ in range(len(counts))]
+
+    for frame in range(num_frames):
+        first, second = _neighbour_pairs(coords[frame], cutoff, cell)
+        matches = (is_element1[first] & is_element2[second]) | (is_element2[first] & is_element1[second])
+        first, second = first[matches], second[matches]
+
+        delta = coords[frame, first] - coords[frame, second]
+        if cell is not None:
+            delta = minimum_image(delta, cell)
+        distances = np.linalg.norm(delta, axis=1)
+        inside = (distances >= bounds[:, :1]) & (distances <= bounds[:, 1:])
+        keys = first * num_atoms + second
+        np.minimum.at(min_distances, keys, distances)
+        for w in range(len(bounds)):
+            pending[w].append(keys[inside[w]])
+        pending[-1].append(keys[inside.any(axis=0)])
+
+        if (frame + 1) % DISCOVERY_FLUSH_FRAMES == 0 or frame == num_frames - 1:
+            for w in range(len(pending)):
+                counts[w] += np.bincount(np.concatenate(pending[w]), minlength=counts.shape[1])
+                pending[w] = []
+
+    return counts, min_distances
+
+
+def discover_atom_pairs(filename, element1, element2, cutoff, top_n, windows=HAT_WINDOWS, cell=None, skip_number=0,
+                        stop_number=None, stride=1, workers=1):
+    # Neighbour search over every frame with a KD-tree, counting the frames each element1-element2 pair
+    # spends inside each window. Frames are read in chunks from the frame index, so memory does not grow
+    # with the trajectory. Returns the top_n pairs (1-indexed) by frames inside any window, and the symbols
+    index = load_frame_index(filename)
+    frames = select_frames(index, skip_number, stop_number, stride)
+    num_atoms = int(index['num_atoms'])
+    symbols = read_indexed_frames(filename, index, frames[:1])[1]
+    is_element1 = np.asarray(symbols) == element1
+    is_element2 = np.asarray(symbols) == element2
+    bounds = np.array(list(windows.values()))
+
+    # dense counts over pair keys i * num_atoms + j, the last row counts frames inside any window
+    counts = np.zeros((len(windows) + 1, num_atoms * num_atoms), dtype=np.int64)
+    min_distances = np.full(num_atoms * num_atoms, np.inf)
+    chunk_size = max(workers, 1) * READ_BLOCK_FRAMES
+
+    print(f"Searching {len(frames)} frames for {element1}-{element2} pairs within {cutoff} A")
+    for chunk_start in range(0, len(frames), chunk_size):
+        coords = read_indexed_frames(filename, index, frames[chunk_start:chunk_start + chunk_size], workers=workers)[0]
+        _count_window_pairs(coords, is_element1, is_element2, bounds, cutoff, cell, counts, min_distances)
+        print(f"Searched {min(chunk_start + chunk_size, len(frames))} of {len(frames)} frames")
+
+    ranked = np.argsort(counts[-1], kind='stable')[::-1][:top_n]
+    ranked = ranked[counts[-1][ranked] > 0]
+    atom_tuple_list = [(int(key // num_atoms) + 1, int(key % num_atoms) + 1) for key in ranked]
+
+    print(f"Found {len(atom_tuple_list)} {element1}-{element2} pairs inside the HAT windows")
+    print("Pair\t" + "\t".join(windows) + "\tany\tmin distance / A")
+    for key, pair in zip(ranked, atom_tuple_list):
+        fractions = "\t".join(f"{counts[w, key] / max(len(frames), 1):.3f}" for w in range(len(counts)))
+        print(f"{_get_atom_pair_string(symbols, pair[0], pair[1])}\t{fractions}\t{min_distances[key]:.3f}")
+
+    return atom_tuple_list, symbols
+
+
+def _report_pairs(sim_list, distances_array, atom_tuple_list, symbols, time_step, accumulators=None):
+    num_tuples = len(atom_tuple_list)
+    atom_pair_list = [_get_atom_pair_string(symbols, pair[0], pair[1]) for pair in atom_tuple_list]
+    if accumulators is not None:
+        standard_errors, inefficiencies = accumulator_block_errors(accumulators)[:2]
+    else:
+        standard_errors = block_average(distances_array)
+        inefficiencies = statistical_inefficiency(standard_errors, np.var(distances_array, axis=1),
+                                                  distances_array.shape[1])
 
-def get_num_steps(filename, skip_number):
-    with open(filename, 'r') as file:
-        lines = file.readlines()
+    for i in range(num_tuples):
+        print(f"Analysing atom pair {i+1} of {num_tuples} =============")
+        atom_number1, atom_number2 = atom_tuple_list[i]
+        atom_label1 = symbols[atom_number1 - 1]
+        atom_label2 = symbols[atom_number2 - 1]
+        distances = distances_array[i]
+
+        print(f"Extracted atom pair data for {atom_pair_list[i]}")
+        summary = accumulator_summary(accumulators, i) if accumulators is not None else None
+        mean_distance, min_distance, max_distance, stdev_distance = _print_analysis(distances, summary)
+        print(f'Std error of mean: {standard_errors[i]:.5f}\n'
+              f'Statistical inefficiency: {inefficiencies[i]:.1f}')
+        _write_csv(atom_label1, atom_number1, atom_label2, atom_number2, mean_distance, min_distance, max_distance, stdev_distance,
+                   standard_errors[i], inefficiencies[i])
+
+        _plot_distance_vs_steps(sim_list,
+                               distances,
+                               atom_label1,
+                               atom_label2,
+                               atom_number1,
+                               atom_number2,
+                               mean_distance,
+                               stdev_distance,
+                               min_distance,
+                               max_distance,
+                               time_step,
+                               show_plots)
+        print("\n")
 
-    # Reverse the lines to read backwards
-    reversed_lines = reversed(lines)
+    return atom_pair_list
 
-    found_last_step = False
-    found_first_step = False
-    num_steps = 0
 
-    for line in reversed_lines:
-        # Check if the line contains the desired string
-        if "# ORCA AIMD Position Step" in line:
-            found_last_step = True
-            # Extract the integer that follows the string, removing the comma
-            last_step_num = int(line.split()[5].rstrip(','))
-            break
+def analyze_trajectories(filename, atom_tuple_list, time_step, skip_number=0, stop_number=None, stride=1,
+                         cache_dir=CACHE_DIR, cache_size=CACHE_SIZE, workers=1, cell=None):
+    sim_list, distances_array, symbols = extract_distances(filename, atom_tuple_list, skip_number, stop_number, stride,
+                                                           cache_dir, cache_size, workers, cell)
+    atom_pair_list = _report_pairs(sim_list, distances_array, atom_tuple_list, symbols, time_step)
 
-    for line in lines:
-        # Check if the line contains the desired string
-        if "# ORCA AIMD Position Step" in line:
-            found_first_step = True
-            # Extract the integer that follows the string, removing the comma
-            first_step_num = int(line.split()[5].rstrip(','))
-            break
+    return distances_array, atom_pair_list
 
-    num_steps = last_step_num - first_step_num + 1
 
-    return num_steps - skip_number
+def analyze_trajectory(filename, atom_number1, atom_number2, time_step, skip_number):
+    distances_array, atom_pair_list = analyze_trajectories(filename, [(atom_number1, atom_number2)], time_step, skip_number)
+
+    return distances_array[0], atom_pair_list[0]
+
+
+def init_accumulators(num_tuples, windows=HAT_WINDOWS, hist_range=HIST_RANGE, bin_width=HIST_BIN_WIDTH):
+    # Constant-memory per-pair statistics updated chunk by chunk: count, mean and sum of squared deviations
+    # (Welford/Chan), min, max, a fixed-bin histogram, the number of frames inside each window, and online
+    # blocking of the means of blocks of STREAM_BLOCK_FRAMES frames of the distances and window indicators
+    edges = np.arange(hist_range[0], hist_range[1] + bin_width / 2, bin_width)
+
+    return {'count': 0,
+            'mean': np.zeros(num_tuples),
+            'm2': np.zeros(num_tuples),
+            'min': np.full(num_tuples, np.inf),
+            'max': np.full(num_tuples, -np.inf),
+            'edges': edges,
+            'histogram': np.zeros((num_tuples, len(edges) - 1), dtype=np.int64),
+            'outside_range': np.zeros(num_tuples, dtype=np.int64),
+            'window_bounds': np.array(list(windows.values()), dtype=float).reshape(-1, 2),
+            'window_counts': np.zeros((num_tuples, len(windows)), dtype=np.int64),
+            'blocking': init_blocking(num_tuples * (1 + len(windows))),
+            'block_remainder': np.empty((num_tuples, 1 + len(windows), 0))}
+
+
+def update_accumulators(accumulators, distances):
+    # Merge a (n_pairs, n_new) block of distances into the accumulators in place
+    num_tuples, num_new = distances.shape
+    if num_new == 0:
+        return accumulators
+
+    new_mean = distances.mean(axis=1)
+    new_m2 = ((distances - new_mean[:, None]) ** 2).sum(axis=1)
+    count = accumulators['count'] + num_new
+    delta = new_mean - accumulators['mean']
+    accumulators['m2'] += new_m2 + delta ** 2 * accumulators['count'] * num_new / count
+    accumulators['mean'] += delta * num_new / count
+    accumulators['count'] = count
+    np.minimum(accumulators['min'], distances.min(axis=1), out=accumulators['min'])
+    np.maximum(accumulators['max'], distances.max(axis=1), out=accumulators['max'])
+
+    edges = accumulators['edges']
+    num_bins = len(edges) - 1
+    bins = np.searchsorted(edges, distances, side='right') - 1
+    bins[distances == edges[-1]] = num_bins - 1
+    in_range = (bins >= 0) & (bins < num_bins)
+    keys = (np.arange(num_tuples)[:, None] * num_bins + bins)[in_range]
+    accumulators['histogram'] += np.bincount(keys, minlength=num_tuples * num_bins).reshape(num_tuples, num_bins)
+    accumulators['outside_range'] += num_new - in_range.sum(axis=1)
+
+    bounds = accumulators['window_bounds']
+    inside = (distances[:, None] >= bounds[None, :, :1]) & (distances[:, None] <= bounds[None, :, 1:])
+    accumulators['window_counts'] += inside.sum(axis=2)
+
+    # frames left over from the last chunk are carried into the next block
+    values = np.concatenate((accumulators['block_remainder'],
+                             np.concatenate((distances[:, None], inside), axis=1)), axis=2)
+    num_blocks = values.shape[2] // STREAM_BLOCK_FRAMES
+    num_blocked = num_blocks * STREAM_BLOCK_FRAMES
+    block_means = values[:, :, :num_blocked].reshape(num_tuples, values.shape[1], num_blocks, STREAM_BLOCK_FRAMES).mean(axis=3)
+    update_blocking(accumulators['blocking'], block_means.reshape(-1, num_blocks))
+    accumulators['block_remainder'] = values[:, :, num_blocked:]
+
+    return accumulators
+
+
+def accumulator_summary(accumulators, i):
+    return (accumulators['mean'][i], accumulators['min'][i], accumulators['max'][i],
+            np.sqrt(accumulators['m2'][i] / accumulators['count']))
+
+
+def accumulator_occupancy(accumulators):
+    return accumulators['window_counts'] / max(accumulators['count'], 1)
+
+
+def accumulator_block_errors(accumulators):
+    # Blocking standard errors of the mean distances and of the window occupancies from the block means,
+    # with the statistical inefficiency of the mean distances
+    num_tuples, num_series = accumulators['block_remainder'].shape[:2]
+    errors = online_block_average(accumulators['blocking']).reshape(num_tuples, num_series)
+    inefficiencies = statistical_inefficiency(errors[:, 0], accumulators['m2'] / max(accumulators['count'], 1),
+                                              accumulators['count'])
+
+    return errors[:, 0], inefficiencies, errors[:, 1:]
+
+
+def accumulator_quantiles(accumulators, quantiles):
+    # Approximate quantiles from the histogram, interpolating linearly inside each bin, (n_pairs, n_quantiles)
+    edges = accumulators['edges']
+    histogram = accumulators['histogram']
+    cumulative = np.cumsum(histogram, axis=1)
+    result = np.empty((len(histogram), len(quantiles)))
+
+    for i in range(len(histogram)):
+        total = cumulative[i, -1]
+        if total == 0:
+            result[i] = np.nan
+            continue
+        targets = np.asarray(quantiles) * total
+        bins = np.minimum(np.searchsorted(cumulative[i], targets, side='left'), len(edges) - 2)
+        below = cumulative[i, bins] - histogram[i, bins]
+        fraction = (targets - below) / np.maximum(histogram[i, bins], 1)
+        values = edges[bins] + fraction * (edges[bins + 1] - edges[bins])
+        result[i] = np.clip(values, accumulators['min'][i], accumulators['max'][i])
+
+    return result
+
+
+def _accumulator_violin_stats(accumulators, num_points=200):
+    # matplotlib violin statistics from the histograms, smoothed with a Gaussian kernel of Scott's bandwidth
+    edges = accumulators['edges']
+    bin_width = edges[1] - edges[0]
+    centres = (edges[:-1] + edges[1:]) / 2
+    medians = accumulator_quantiles(accumulators, [0.5])[:, 0]
+    vpstats = []
+
+    for i in range(len(accumulators['histogram'])):
+        mean, min_distance, max_distance, stdev_distance = accumulator_summary(accumulators, i)
+        bandwidth = max(stdev_distance * accumulators['count'] ** (-1 / 5), bin_width)
+        density = gaussian_filter1d(accumulators['histogram'][i].astype(float), bandwidth / bin_width, mode='constant')
+        coords = np.linspace(min_distance, max_distance, num_points)
+        vals = np.interp(coords, centres, density)
+        vpstats.append({'coords': coords, 'vals': vals / max(vals.max(), 1e-300),
+                        'mean': mean, 'median': medians[i], 'min': min_distance, 'max': max_distance})
+
+    return vpstats
+
+
+def stream_trajectory(filename, atom_tuple_list, time_step, skip_number=0, stop_number=None, stride=1, workers=1,
+                      cell=None, windows=HAT_WINDOWS, hist_range=HIST_RANGE, bin_width=HIST_BIN_WIDTH):
+    # Bounded-memory analysis: frames are read in chunks and folded into the accumulators, keeping only a
+    # decimated trace of at most MAX_TRACE_POINTS frames per pair for the distance vs time plots
+    index = load_frame_index(filename)
+    frames = select_frames(index, skip_number, stop_number, stride)
+    accumulators = init_accumulators(len(atom_tuple_list), windows, hist_range, bin_width)
+    trace_stride = max(1, -(-len(frames) // MAX_TRACE_POINTS))
+    chunk_size = 4 * max(workers, 1) * READ_BLOCK_FRAMES
+    trace = [np.empty((len(atom_tuple_list), 0))]
+    symbols = None
+
+    for chunk_start in range(0, len(frames), chunk_size):
+        distances, symbols = read_indexed_frames(filename, index, frames[chunk_start:chunk_start + chunk_size],
+                                                 workers=workers, atom_tuple_list=atom_tuple_list, cell=cell)
+        update_accumulators(accumulators, distances)
+        trace.append(distances[:, (-chunk_start) % trace_stride::trace_stride])
+        print(f"Processed {min(chunk_start + chunk_size, len(frames))} of {len(frames)} frames")
+
+    sim_list = skip_number + stride * np.arange(0, len(frames), trace_stride)
+    atom_pair_list = _report_pairs(sim_list, np.concatenate(trace, axis=1), atom_tuple_list, symbols, time_step,
+                                   accumulators)
+
+    return accumulators, atom_pair_list
+
+
+def _follow_key(filename, atom_tuple_list, skip_number, stride, cell):
+    # Identify the analysis by path and settings, the saved state records which indexed region it covers
+    digest = hashlib.sha256()
+    digest.update(f'{os.path.abspath(filename)}|{atom_tuple_list}|skip={skip_number}|stride={stride}'.encode())
+    if cell is not None:
+        digest.update(np.asarray(cell, dtype=float).tobytes())
 
+    return digest.hexdigest()[:24]
 
-def analyze_trajectory(filename, atom_number1, atom_number2, time_step, skip_number):
-    distances = []
-    sim_list = []
-    atom1_type = []
-    atom2_type = []
-    atom_types_list = []
-    checkpoint_file_exists = False
-
-    print("Extracting atom types and checking for checkpoint file...")
-    with open(filename, 'r') as file:
-        lines = file.readlines()
-    i = 0
-    while i < len(lines):
-        if lines[i].strip().isdigit():
-            num_atoms = int(lines[i])
-            i += 2
-            for j in range(num_atoms):
-                atom_types = [coord for coord in lines[i].split()]
-                atom_types_list.append(atom_types)
-                i += 1
-            break
-
-    atom_label1 = str(atom_types_list[atom_number1 - 1][0])
-    atom_label2 = str(atom_types_list[atom_number2 - 1][0])
-    atom_pair_string = str(atom_label1 + str(atom_number1) + '-' + atom_label2 + str(atom_number2))
-
-    checkpoint_filename = f'{atom_pair_string}.pkl'
-    if not os.path.isfile(checkpoint_filename):
-        print("Checkpoint file not found, initiating data extraction")
-
-        i = 0
-        sim_step = 0
-        print("Reading trajectory")
-        while i < len(lines):
-            if lines[i].strip().isdigit():
-                num_atoms = int(lines[i])
-                i += 2
-                current_coords = []
-
-                for j in range(num_atoms):
-                    atom_types = [str(coord) for coord in lines[i].split()[0]]
-                    coords = [float(coord) for coord in lines[i].split()[1:]]
-                    current_coords.append(coords)
-                    i += 1
-
-                if not sim_step < skip_number:
-                    # switched atom numbering from 1-index to 0-index
-                    if len(current_coords) == num_atoms:
-                        atom1_coords = current_coords[atom_number1-1]
-                        atom2_coords = current_coords[atom_number2-1]
-                        distance = np.linalg.norm(np.array(atom1_coords) - np.array(atom2_coords))
-                        sim_list.append(sim_step)
-                        distances.append(distance)
-
-                sim_step += 1
-
-            else:
-                i += 1
-
-        _write_checkpoints(checkpoint_filename,sim_list,distances)
 
-    else:
-        print(f"Checkpoint file {checkpoint_filename} found, extracting distances...")
-        sim_list, distances = _extract_distances_from_checkpoint(checkpoint_filename)
-
-    print(f"Extracted atom pair data for {atom_pair_string}")
-    mean_distance, min_distance, max_distance, stdev_distance = _print_analysis(distances)
-    _write_csv(atom_label1, atom_number1, atom_label2, atom_number2, mean_distance, min_distance, max_distance, stdev_distance)
-
-    _plot_distance_vs_steps(sim_list,
-                           distances,
-                           atom_label1,
-                           atom_label2,
-                           atom_number1,
-                           atom_number2,
-                           mean_distance,
-                           stdev_distance,
-                           min_distance,
-                           max_distance,
-                           time_step,
-                           show_plots)
-
-    return distances, atom_pair_string
-
-
-def _print_analysis(distances):
-
-    mean_distance = np.mean(distances)
-    min_distance = np.min(distances)
-    max_distance = np.max(distances)
-    stdev_distance = np.std(distances)
+def _discard_follow_state(cache_dir, key):
+    for suffix in ('npz', 'bin'):
+        path = os.path.join(cache_dir, f'{key}_follow.{suffix}')
+        if os.path.isfile(path):
+            os.remove(path)
+
+    return None
+
+
+def _load_follow_state(cache_dir, key, num_tuples, filename):
+    # Distances saved by a previous run, as long as the trajectory region they were read from is unchanged
+    state_path = os.path.join(cache_dir, f'{key}_follow.npz')
+    distances_path = os.path.join(cache_dir, f'{key}_follow.bin')
+    if not os.path.isfile(state_path) or not os.path.isfile(distances_path):
+        return 0, np.empty((num_tuples, 0)), None
+
+    with np.load(state_path) as data:
+        state = {name: data[name] for name in data.files}
+    if not index_matches(filename, state):
+        print(f"{filename} has changed since it was last followed, discarding the saved distances")
+        _discard_follow_state(cache_dir, key)
+        return 0, np.empty((num_tuples, 0)), None
+    num_processed = int(state['num_processed'])
+
+    # Distances are appended frame by frame, drop anything written after the last saved state
+    distances = np.fromfile(distances_path, dtype=np.float64, count=num_processed * num_tuples)
+    print(f"Resuming from {num_processed} previously processed frames")
+
+    return num_processed, distances.reshape(num_processed, num_tuples).T, state
+
+
+def _save_follow_state(cache_dir, key, new_distances, num_processed, region):
+    os.makedirs(cache_dir, exist_ok=True)
+    distances_path = os.path.join(cache_dir, f'{key}_follow.bin')
+    with open(distances_path, 'r+b' if os.path.isfile(distances_path) else 'wb') as file:
+        file.truncate((num_processed - new_distances.shape[1]) * new_distances.shape[0] * 8)
+        file.seek(0, os.SEEK_END)
+        file.write(np.ascontiguousarray(new_distances.T).tobytes())
+
+    state_path = os.path.join(cache_dir, f'{key}_follow.npz')
+    tmp_path = f'{state_path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as file:
+        np.savez(file, num_processed=num_processed, **region)
+    os.replace(tmp_path, state_path)
+
+    return None
+
+
+def follow_trajectory(filename, atom_tuple_list, time_step, skip_number=0, stop_number=None, stride=1,
+                      cache_dir=CACHE_DIR, poll_interval=60, workers=1, cell=None, windows=HAT_WINDOWS):
+    # Poll a running trajectory, parsing only complete frames appended since the last poll and
+    # refreshing output.csv and the plots whenever new frames arrive
+    num_tuples = len(atom_tuple_list)
+    key = _follow_key(filename, atom_tuple_list, skip_number, stride, cell) if cache_dir is not None else None
+    num_processed = 0
+    distances_array = np.empty((num_tuples, 0))
+    accumulators = init_accumulators(num_tuples, windows)
+    # indexed region the processed frames were read from
+    region = None
+    refreshed = False
+    if key is not None:
+        num_processed, distances_array, region = _load_follow_state(cache_dir, key, num_tuples, filename)
+        update_accumulators(accumulators, distances_array)
+
+    try:
+        while True:
+            index = load_frame_index(filename)
+
+            # Start again if the trajectory was replaced rather than appended to
+            if region is not None and not index_matches(filename, region):
+                print(f"{filename} was replaced, restarting from its first frame")
+                if key is not None:
+                    _discard_follow_state(cache_dir, key)
+                num_processed = 0
+                distances_array = np.empty((num_tuples, 0))
+                accumulators = init_accumulators(num_tuples, windows)
+                region = None
+
+            frames = select_frames(index, skip_number, stop_number, stride)
+            new_frames = frames[num_processed:]
+            if len(new_frames):
+                print(f"Reading {len(new_frames)} new frames")
+                new_distances, symbols = read_indexed_frames(filename, index, new_frames, workers=workers,
+                                                             atom_tuple_list=atom_tuple_list, cell=cell)
+                num_processed += len(new_frames)
+                distances_array = np.concatenate((distances_array, new_distances), axis=1)
+                update_accumulators(accumulators, new_distances)
+                region = {name: index[name] for name in ('start', 'end', 'head', 'tail')}
+                if key is not None:
+                    _save_follow_state(cache_dir, key, new_distances, num_processed, region)
+
+            # Refresh the outputs after new frames, or once for frames resumed from a previous run
+            if num_processed and (len(new_frames) or not refreshed):
+                refreshed = True
+                symbols = read_indexed_frames(filename, index, [0])[1]
+                sim_list = skip_number + stride * np.arange(num_processed)
+                create_csv(csv_file_path)
+                atom_pair_list = _report_pairs(sim_list, distances_array, atom_tuple_list, symbols, time_step, accumulators)
+                make_violin_plots(distances_array, atom_pair_list, windows)
+                write_occupancy(accumulator_occupancy(accumulators), atom_pair_list, windows,
+                                errors=accumulator_block_errors(accumulators)[2])
+
+            if stop_number is not None and len(index['offsets']) >= stop_number:
+                print(f"Reached frame {stop_number}, stopped following")
+                break
+
+            print(f"Processed {num_processed} frames, waiting {poll_interval} s for new frames")
+            time.sleep(poll_interval)
+
+    except KeyboardInterrupt:
+        print("Stopped following")
+
+    return distances_array
+
+
+def _print_analysis(distances, summary=None):
+
+    if summary is None:
+        summary = (np.mean(distances), np.min(distances), np.max(distances), np.std(distances))
+    mean_distance, min_distance, max_distance, stdev_distance = summary
     print(f'Mean distance: {mean_distance:.3f}\n'
           f'Min distance: {min_distance:.3f}\n'
           f'Max distance: {max_distance:.3f}\n'
@@ -218,10 +631,12 @@ def _plot_distance_vs_steps(sim_list,
 def create_csv(csv_file_path):
     with open(csv_file_path, mode='w', newline='') as file:
         writer = csv.writer(file)
-        writer.writerow(["Atom1", "Atom2", "Mean distance / A", "Min distance / A", "Max distance / A", "Std dev distance / A"])
+        writer.writerow(["Atom1", "Atom2", "Mean distance / A", "Min distance / A", "Max distance / A", "Std dev distance / A",
+                         "Std error mean distance / A", "Statistical inefficiency"])
 
 
-def _write_csv(atom_label1, atom_number1, atom_label2, atom_number2, mean_distance, min_distance, max_distance, stdev_distance):
+def _write_csv(atom_label1, atom_number1, atom_label2, atom_number2, mean_distance, min_distance, max_distance, stdev_distance,
+               stderr_distance, inefficiency):
 
     atom1 = str(atom_label1)+str(atom_number1)
     atom2 = str(atom_label2)+str(atom_number2)
@@ -230,42 +645,71 @@ def _write_csv(atom_label1, atom_number1, atom_label2, atom_number2, mean_distan
 
     with open(csv_file_path, mode='a', newline='') as file:
         writer = csv.writer(file)
-        writer.writerow((atom1, atom2, mean_distance, min_distance, max_distance, stdev_distance))
+        writer.writerow((atom1, atom2, mean_distance, min_distance, max_distance, stdev_distance, stderr_distance, inefficiency))
+
 
+def load_windows(filename):
+    with open(filename, 'r') as file:
+        windows = json.load(file)
 
-def _write_checkpoints(checkpoint_filename,sim_list,distances):
+    return {str(name): (float(bounds[0]), float(bounds[1])) for name, bounds in windows.items()}
 
-    with open(checkpoint_filename, "wb") as file:
-        pickle.dump(sim_list, file)
-        pickle.dump(distances, file)
 
-    return None
+def window_occupancy(distances_array, windows=HAT_WINDOWS):
+    # Fraction of frames each pair spends inside each window, (n_pairs, n_windows)
+    distances_array = np.asarray(distances_array)
+    occupancy = np.empty((distances_array.shape[0], len(windows)))
+    for w, (lower, upper) in enumerate(windows.values()):
+        occupancy[:, w] = np.mean((distances_array >= lower) & (distances_array <= upper), axis=1)
 
+    return occupancy
 
-def _extract_distances_from_checkpoint(checkpoint_filename):
 
-    with open(checkpoint_filename, "rb") as file:
-        extracted_sim_list = pickle.load(file)
-        extracted_distances = pickle.load(file)
+def window_occupancy_errors(distances_array, windows=HAT_WINDOWS):
+    # Blocking standard error of each window occupancy, batched over all pairs, (n_pairs, n_windows)
+    distances_array = np.asarray(distances_array)
+    errors = np.empty((distances_array.shape[0], len(windows)))
+    for w, (lower, upper) in enumerate(windows.values()):
+        errors[:, w] = block_average(((distances_array >= lower) & (distances_array <= upper)).astype(np.float32))
 
-    return extracted_sim_list, extracted_distances
+    return errors
 
 
-def make_violin_plots(distances_array, atom_pair_list):
+def write_occupancy(occupancy, atom_pair_list, windows=HAT_WINDOWS, occupancy_file_path='occupancy.csv',
+                    errors=None, error_file_path='occupancy_error.csv'):
+    # Pairs as rows and windows as columns, loaded by mof_heatmap.py. Standard errors go to a second file
+    # with the same layout
+    tables = [(occupancy_file_path, occupancy)]
+    if errors is not None:
+        tables.append((error_file_path, errors))
+
+    for file_path, table in tables:
+        print(f"Writing window occupancy to {file_path}...")
+        with open(file_path, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(["Atom pair"] + list(windows))
+            for atom_pair_string, row in zip(atom_pair_list, table):
+                writer.writerow([atom_pair_string] + [f'{value:.6f}' for value in row])
+
+    return None
+
+
+def make_violin_plots(distances_array, atom_pair_list, windows=HAT_WINDOWS, accumulators=None):
 
     plt.clf()
 
-    plt.violinplot(distances_array.T, showmedians=True)
+    if accumulators is not None:
+        plt.gca().violin(_accumulator_violin_stats(accumulators), showmedians=True)
+    else:
+        plt.violinplot(distances_array.T, showmedians=True)
     plt.xticks(range(1, len(atom_pair_list) + 1), atom_pair_list, rotation=45, ha='right', fontsize=10)
     plt.xlabel('Atom pair', fontsize=14)
     plt.tick_params(axis='x', labelsize=14)
     plt.ylabel(f'Distance / Å', fontsize=14)
     plt.tick_params(axis='y', labelsize=14)
 
-    plt.axhspan(3.80, 3.86, color='red', alpha=0.1)  # alkyl radical HAT C–C distance range (2.70-2.76) + C–H bond length (1.1 A) to correct for C–H/C–H clash in MD simulations
-    plt.axhspan(3.45, 3.52, color='blue', alpha=0.1)  # alkoxy radical HAT C–C distance range
-    plt.axhspan(3.78, 4.33, color='green', alpha=0.1)  # peroxy radical HAT C–C distance range
-    plt.axhspan(5.068, 5.109, color='purple', alpha=0.1)  # bimolecular peroxy decomposition C–C distance range
+    for w, (name, (lower, upper)) in enumerate(windows.items()):
+        plt.axhspan(lower, upper, color=WINDOW_COLORS.get(name, f'C{w}'), alpha=0.1)
 
     plt.tight_layout()
     plt.savefig('violin.pdf')
@@ -275,6 +719,43 @@ def make_violin_plots(distances_array, atom_pair_list):
     return None
 
 
+def make_spectra_plots(distances_array, atom_pair_list, time_step, spectra_file_path='spectra.csv',
+                       autocorrelation_file_path='autocorrelation.csv'):
+    # Autocorrelation and power spectrum of every pair's distance series, each from one FFT over all pairs
+    acf = autocorrelation(distances_array)
+    frequencies, power = power_spectrum(distances_array, time_step)
+    lags = np.arange(acf.shape[1]) * time_step
+
+    for atom_pair_string, frequency in zip(atom_pair_list, dominant_frequencies(frequencies, power)):
+        print(f"{atom_pair_string} dominant frequency: {frequency:.1f} cm-1")
+
+    print(f"Writing autocorrelation functions to {autocorrelation_file_path} and spectra to {spectra_file_path}...")
+    np.savetxt(autocorrelation_file_path, np.column_stack((lags, acf.T)), delimiter=',', comments='',
+               header=','.join(['Lag / fs'] + list(atom_pair_list)))
+    np.savetxt(spectra_file_path, np.column_stack((frequencies, power.T)), delimiter=',', comments='',
+               header=','.join(['Frequency / cm-1'] + list(atom_pair_list)))
+
+    fig, axs = plt.subplots(2, 1, figsize=(8, 8))
+    for i, atom_pair_string in enumerate(atom_pair_list):
+        axs[0].plot(lags, acf[i], label=atom_pair_string, linewidth=0.8)
+        axs[1].plot(frequencies, power[i] / np.max(power[i], initial=1e-300), label=atom_pair_string, linewidth=0.8)
+    axs[0].set_xlabel('Lag / fs', fontsize=14)
+    axs[0].set_ylabel('Autocorrelation', fontsize=14)
+    axs[0].set_xlim(0, lags[-1] / 2 if len(lags) > 1 else 1)
+    axs[1].set_xlabel('Frequency / cm$^{-1}$', fontsize=14)
+    axs[1].set_ylabel('Normalised power', fontsize=14)
+    axs[1].set_xlim(0, min(frequencies[-1], 4000) if len(frequencies) > 1 else 1)
+    axs[0].legend(fontsize=8)
+
+    plt.tight_layout()
+    plt.savefig('spectra.pdf')
+    if show_plots:
+        plt.show()
+    plt.close(fig)
+
+    return None
+
+
 if __name__ == "__main__":
 
     args = get_args()
@@ -283,25 +764,61 @@ if __name__ == "__main__":
     time_step = args.time_step
     show_plots = args.show_plots
     skip_number = args.skip
+    stop_number = args.stop
+    stride = args.stride
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_size = args.cache_size * 1e9
+    workers = args.workers
+    cell = cell_matrix(args.cell) if args.cell is not None else None
+    windows = load_windows(args.windows) if args.windows is not None else HAT_WINDOWS
 
     csv_file_path = "output.csv"
     create_csv(csv_file_path)
 
-    num_steps = get_num_steps(file_path, skip_number)
-    num_tuples = len(atom_tuple_list)
+    if args.discover is not None:
+        cutoff = args.cutoff if args.cutoff is not None else max(window[1] for window in windows.values())
+        atom_tuple_list = discover_atom_pairs(file_path, args.discover[0], args.discover[1], cutoff, args.top, windows,
+                                              cell, skip_number, stop_number, stride, workers)[0]
+    elif atom_tuple_list is None:
+        raise SystemExit("Either --atom_pair or --discover must be given")
 
-    distances_array = np.empty((num_tuples,num_steps))
-    atom_pair_list = []
+    if args.spectra and time_step is None:
+        raise SystemExit("--spectra needs the time step, --time_step")
 
-    for i in range(num_tuples):
-        sim_list, distances = [], []
-        print(f"Initiating analysis of atom pair {i+1} of {len(atom_tuple_list)} =============")
+    if args.follow:
+        # Never block on plot windows between polls
+        show_plots = False
+        print(f"Following {file_path} for {len(atom_tuple_list)} atom pairs =============")
+        follow_trajectory(file_path, atom_tuple_list, time_step, skip_number, stop_number, stride,
+                          cache_dir, args.poll_interval, workers, cell, windows)
 
-        distances_array[i], atom_pair_string = analyze_trajectory(file_path, atom_tuple_list[i][0], atom_tuple_list[i][1], time_step, skip_number)
-        atom_pair_list.append(atom_pair_string)
-        print("\n")
+    elif args.streaming:
+        print(f"Initiating streaming analysis of {len(atom_tuple_list)} atom pairs =============")
+        accumulators, atom_pair_list = stream_trajectory(file_path, atom_tuple_list, time_step, skip_number, stop_number,
+                                                         stride, workers, cell, windows, args.hist_range, args.bin_width)
+
+        print("Creating violin plots")
+        make_violin_plots(None, atom_pair_list, windows, accumulators)
+
+        write_occupancy(accumulator_occupancy(accumulators), atom_pair_list, windows,
+                        errors=accumulator_block_errors(accumulators)[2])
+
+        if args.spectra:
+            print("Spectra need the full distance series and are not computed with --streaming")
+
+    else:
+        print(f"Initiating analysis of {len(atom_tuple_list)} atom pairs =============")
+        distances_array, atom_pair_list = analyze_trajectories(file_path, atom_tuple_list, time_step, skip_number, stop_number,
+                                                              stride, cache_dir, cache_size, workers, cell)
+
+        print("Creating violin plots")
+        make_violin_plots(distances_array, atom_pair_list, windows)
+
+        write_occupancy(window_occupancy(distances_array, windows), atom_pair_list, windows,
+                        errors=window_occupancy_errors(distances_array, windows))
 
-    print("Creating violin plots")
-    make_violin_plots(distances_array, atom_pair_list)
+        if args.spectra:
+            print("Computing autocorrelation functions and spectra")
+            make_spectra_plots(distances_array, atom_pair_list, time_step * stride)
 
     print("Analysis complete")